@@ -1,10 +1,16 @@
 import os, io
+import hmac
 import json
 from urllib.parse import quote_plus, urlencode
 from functools import wraps
-from flask import Flask, render_template, url_for, redirect, request, session, jsonify, send_file
+import click
+from flask import Flask, render_template, url_for, redirect, request, session, jsonify, send_file, Response, stream_with_context
 from markupsafe import escape
 import db
+import migrate
+import nutrients
+import parserPool
+import scrapeJobs
 
 from authlib.integrations.flask_client import OAuth
 from dotenv import load_dotenv
@@ -14,7 +20,8 @@ from markupsafe import escape
 # https://docs.recipe-scrapers.com/
 # from recipe_scrapers import scrape_me
 
-from recipeUtil import scrape_link, get_ingredient_nutrition
+from recipeUtil import canonical_url, get_ingredient_nutrition, get_batch_nutrition, iter_batch_nutrition, USDA_CACHE, USDA_FLIGHT, NUTRITION_POOL, PARSER_POOL, PARSE_CACHE
+import usdaClient
 
 import random
 
@@ -22,6 +29,22 @@ load_dotenv(".env")
 app = Flask(__name__)
 app.secret_key = os.environ.get("APP_SECRET_KEY")
 db.setup()
+db.init_app(app)
+
+# Schema changes are a deploy step: `flask --app app migrate` before starting the web processes
+# MIGRATE_ON_START=1 runs them here instead (single process setups), never in parser pool
+#   children, which re-import this module when it is run as `python app.py`
+if os.getenv("MIGRATE_ON_START", "0") == "1" and not parserPool.is_worker():
+    migrate.migrate()
+
+# Keep trending scores current (TRENDING_REFRESH_SECONDS=0 to schedule `flask refresh-trending` instead)
+TRENDING_REFRESH_SECONDS = int(os.getenv("TRENDING_REFRESH_SECONDS", 5 * 60))
+if TRENDING_REFRESH_SECONDS > 0 and not parserPool.is_worker():
+    db.start_trending_refresh(TRENDING_REFRESH_SECONDS)
+
+# Start parser processes (PARSER_BACKEND=process) before the first request needs them
+if PARSER_POOL != None:
+    PARSER_POOL.prewarm()
 
 
 ## OAuth ##
@@ -125,26 +148,20 @@ def parse_image_data(image):
 @app.route("/")
 def home():
     user = 'user' in session # change to session user
-    recipes = db.get_recipes(limit=6)
-    print([recipe.keys() for recipe in recipes])
-    ratings = ["★ ★ ★ ★ ☆", "★ ★ ★ ★ ★"]
-    recipe_items = {"trending": [], "top_rated": [], "recent": []}
-    # need to add these keys cause the table doesn't contain them
-    # checking if backend data and front end is the smae
-
-    tag_names = db.get_tag_name()
-    with db.get_db_cursor(commit=False) as cur:
-        recipe_items = {
-            "trending": db.get_recipes(limit=6, cur=cur),
-            "top_rated": db.get_recipes(limit=6, minAvgRating=3, cur=cur),
-            "recent": db.get_recipes(limit=6, recent=True, cur=cur)
-        }
-        print(len(recipe_items["trending"]))
-        print(len(recipe_items["top_rated"]))
-        print(len(recipe_items["recent"]))
-
-        
-    return render_template("main.html", user=user, recipes=recipe_items, tags=tag_names)
+    # Same for every visitor, served from the per process cache (see db.get_home_feed)
+    feed = db.get_home_feed()
+    recipe_items = {name: feed[name] for name in db.HOME_ROWS}
+    return render_template("main.html", user=user, recipes=recipe_items, tags=feed["tags"])
+
+SEARCH_PAGE_SIZE = 20
+
+# One page of search results, ranked for a text query, newest first for tags alone
+# Returns (recipes, next cursor), raises ValueError for a bad cursor
+def search_page(query, tagIDs, minRating=None, limit=SEARCH_PAGE_SIZE, cursor=None):
+    return db.get_recipes_page(
+        search=query or None, tags=tagIDs, minAvgRating=minRating,
+        order="rank" if query else "recent", limit=limit, after=cursor
+    )
 
 @app.route("/search", methods=["GET", "POST"])
 def search():
@@ -153,10 +170,21 @@ def search():
     explore_more = db.get_recipes(limit=8, random=True)
     if request.method == "GET":
         query = request.args.get("q", "").strip()
+        tag_string = request.args.get("tags", "")
+        selected_tag_ids = [db.tags[t.strip()] for t in tag_string.split(",") if t.strip() in db.tags]
         print(query)
-        results = db.get_recipes(titleTerms=[query], limit=5)
-        print(results)
-        return render_template("search.html", user=user, results=results, query=query, explore_recipes=explore_more)
+        next_cursor = None
+        if query or selected_tag_ids:
+            try:
+                results, next_cursor = search_page(query, selected_tag_ids, cursor=request.args.get("cursor"))
+            except ValueError:
+                results, next_cursor = search_page(query, selected_tag_ids)
+        else:
+            results = db.get_recipes(limit=SEARCH_PAGE_SIZE)
+        return render_template(
+            "search.html", user=user, results=results, query=query, selected_tag=tag_string,
+            next_cursor=next_cursor, explore_recipes=explore_more
+        )
 
 
     if request.method == "POST":
@@ -167,10 +195,9 @@ def search():
         selected_tag_ids = [db.tags[t] for t in selected_tags if t in db.tags]
 
         print("Converted tag IDs:", selected_tag_ids)
-        results = db.get_recipes(tags=selected_tag_ids, limit=5)
-        print(results)
+        results, next_cursor = search_page(None, selected_tag_ids)
         
-        return render_template("search.html", user=user, results=results, selected_tag=tag_string, explore_recipes=explore_more)
+        return render_template("search.html", user=user, results=results, selected_tag=tag_string, next_cursor=next_cursor, explore_recipes=explore_more)
         # recipe_q = request.form.get("query", "")
         # tag_string = request.form.get("tags", "")
         # selected_tags = [t.strip() for t in tag_string.split(",") if t.strip()]
@@ -325,14 +352,45 @@ def recipeEdit(recipeID=None, recipe={}):
             # Check submitted autofill link
             link = request.args.get("recipe-link")
             linkType = request.args.get("link-type")
+
+            # Already imported by someone? prefill from our copy, no scrape needed
+            existing = None
+            if link != None and linkType != "CLEAR" and request.args.get("force") == None:
+                existing = db.get_recipe_by_link([link, canonical_url(link)])
+
             if linkType == "CLEAR":
                 return redirect("/recipe/edit")
             
-            # Try auto filling the form
+            elif existing != None:
+                recipe = {key: existing.get(key) for key in (
+                    "link", "title", "brief", "cooktime", "servings", "kcal", "steps", "ingredients", "nutrients", "tags"
+                )}
+                image = db.get_image(recipeID=existing["recipeid"])
+                if isinstance(image, str):
+                    recipe["image_url"] = image
+                recipe["existing"] = existing
+                return render_template("recipe-edit.html", recipe=recipe, user=True)
+
+            # Try auto filling the form, scraped in the background
             elif link != None:
-                recipe = scrape_link(link)
-                if recipe == None:
-                    recipe = {"linkstatus": "Unable to parse link"}
+                try:
+                    jobID = scrapeJobs.submit(link)
+                except scrapeJobs.QueueFull:
+                    recipe = {"linkstatus": "Too many imports running, try again shortly"}
+                    return render_template("recipe-edit.html", recipe=recipe, user=True)
+                return redirect(url_for("recipeEdit", job=jobID))
+
+            # Autofill job submitted, show result or keep polling
+            elif request.args.get("job"):
+                job = scrapeJobs.status(request.args.get("job"))
+                if job == None:
+                    recipe = {"linkstatus": "Import expired, please submit the link again"}
+                elif job["status"] == "done":
+                    recipe = job["recipe"]
+                elif job["status"] == "failed":
+                    recipe = {"linkstatus": job.get("error")}
+                else:
+                    recipe = {"linkstatus": "Fetching recipe...", "scrapejob": request.args.get("job")}
                 return render_template("recipe-edit.html", recipe=recipe, user=True)
             
             else:
@@ -385,6 +443,19 @@ def recipeEdit(recipeID=None, recipe={}):
         recipe["draft"] = recipe.get("draft", False)
         recipe["userID"] = userID
         recipe["nutrients"] = json.loads(request.form.get("nutrients"))
+        if recipe.get("link"):
+            recipe["link"] = canonical_url(recipe["link"])
+
+        # Label totals are recomputed here rather than trusting the client's sums
+        try:
+            servings = int(recipe.get("servings") or 1)
+        except ValueError:
+            servings = 1
+        totals = nutrients.recipe_totals(recipe["nutrients"], servings)
+        if len(recipe["nutrients"]) > 0:
+            recipe["nutrients"][0] = {"total": totals["per_serving"]}
+        if not recipe.get("kcal"):
+            recipe["kcal"] = int(round(totals["kcal"]))
 
         recipeID = db.submit_recipe(
             recipe, 
@@ -471,6 +542,69 @@ def save_recipe(recipeID):
     db.submit_interact_save(recipeID, session["userID"], saved=want_saved)
     return jsonify(success=True, saved=want_saved)
 
+# Recipe card fields sent by the listing APIs
+CARD_FIELDS = ["recipeid", "title", "brief", "author", "tags", "avg_rating", "ratings", "kcal", "cooktime", "servings", "image_url"]
+
+
+# Ranked recipe search
+# GET ?q=...&tags=a,b&minRating=3&pageSize=20&cursor=...
+#   tags / minRating filter like the search page, pass back "cursor" for the next page
+@app.route("/api/search", methods=["GET"])
+def searchRecipes():
+    query = request.args.get("q", "").strip()
+    tagIDs = [db.tags[t.strip()] for t in request.args.get("tags", "").split(",") if t.strip() in db.tags]
+    minRating = request.args.get("minRating", type=float)
+    pageSize = min(max(1, request.args.get("pageSize", SEARCH_PAGE_SIZE, type=int)), 100)
+    if not query and len(tagIDs) == 0:
+        return jsonify(success=False, message="q or tags required"), 400
+
+    try:
+        rows, cursor = search_page(query, tagIDs, minRating, limit=pageSize, cursor=request.args.get("cursor"))
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+    return jsonify(success=True, cursor=cursor, results=[{key: row.get(key) for key in CARD_FIELDS} for row in rows])
+
+
+# A page of one profile tab (posts, saved, drafts) for the logged in user
+# GET ?cursor=..., pass back "cursor" for the next page
+@app.route("/api/profile/<tab>", methods=["GET"])
+def profileTab(tab):
+    userID = session.get("userID")
+    if not userID:
+        return jsonify(success=False, message="Login required"), 401
+    if tab not in PROFILE_TABS:
+        return jsonify(success=False, message="Unknown tab"), 404
+
+    try:
+        rows, cursor = PROFILE_TABS[tab](userID, after=request.args.get("cursor"))
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+    return jsonify(success=True, cursor=cursor, results=[{key: row.get(key) for key in CARD_FIELDS} for row in rows])
+
+
+# Queue a recipe link scrape
+# Body: {"link": url}, returns the job id to poll
+@app.route("/api/scrape", methods=["POST"])
+def submitScrape():
+    link = (request.get_json(silent=True) or {}).get("link")
+    if not link:
+        return jsonify(success=False, message="link required"), 400
+    try:
+        jobID = scrapeJobs.submit(link)
+    except scrapeJobs.QueueFull:
+        return jsonify(success=False, message="Too many imports running, try again shortly"), 503
+    return jsonify(success=True, job=jobID), 202
+
+
+# Poll a scrape job
+@app.route("/api/scrape/<jobID>", methods=["GET"])
+def scrapeStatus(jobID):
+    job = scrapeJobs.status(jobID)
+    if job == None:
+        return jsonify(success=False, message="Unknown or expired job"), 404
+    return jsonify(success=True, job=job)
+
+
 # Get nutritional matches from the USDA
 # Works on singular ingredient string
 @app.route("/api/nutrition", methods=["GET"])
@@ -479,6 +613,66 @@ def getNutrition():
     if nutrients == None:
         return jsonify(success=False)
     return jsonify(success=True, data=nutrients)
+
+
+# Get nutritional matches for a whole ingredient list
+# Body: {"ingredients": [...]}, results keyed by input index
+@app.route("/api/nutrition/batch", methods=["POST"])
+def getNutritionBatch():
+    payload = request.get_json(silent=True) or {}
+    ingredients = payload.get("ingredients")
+    if not isinstance(ingredients, list) or not all(isinstance(ing, str) for ing in ingredients):
+        return jsonify(success=False, message="ingredients must be a list of strings"), 400
+    if len(ingredients) > 100:
+        return jsonify(success=False, message="Too many ingredients (max 100)"), 400
+
+    nutrients = get_batch_nutrition(ingredients)
+    return jsonify(success=True, data={i: res for i, res in enumerate(nutrients)})
+
+
+# Stream nutritional matches as server sent events
+# GET ?ingredient=...&ingredient=...
+#   "ingredient" event per resolved line {"index": i, "data": options or null}, then "done"
+@app.route("/api/nutrition/stream", methods=["GET"])
+def streamNutrition():
+    ingredients = request.args.getlist("ingredient")
+    if len(ingredients) > 100:
+        return jsonify(success=False, message="Too many ingredients (max 100)"), 400
+
+    def events():
+        for i, res in iter_batch_nutrition(ingredients):
+            yield f"event: ingredient\ndata: {json.dumps({'index': i, 'data': res})}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# Cache / pool counters for tuning
+# Admins only, or a request with the METRICS_TOKEN header (for a scraper / dashboard)
+@app.route("/api/metrics", methods=["GET"])
+def metrics():
+    token = os.getenv("METRICS_TOKEN")
+    sent = request.headers.get("X-Metrics-Token", "")
+    if not session.get("is_admin") and not (token and hmac.compare_digest(sent, token)):
+        return jsonify(success=False, message="Unauthorized"), 401
+
+    return jsonify(
+        usda_cache=USDA_CACHE.stats(),
+        usda_client=usdaClient.stats(),
+        usda_single_flight=USDA_FLIGHT.stats(),
+        nutrition_pool=NUTRITION_POOL.stats(),
+        parser_pool=PARSER_POOL.stats() if PARSER_POOL != None else None,
+        parse_cache=PARSE_CACHE.stats(),
+        scrape_pool=scrapeJobs.SCRAPE_POOL.stats(),
+        db_pool=db.pool.stats(),
+        db_replicas=db.replicas.stats() if db.replicas != None else None,
+        recipe_queries=db.query_stats(),
+        home_feed=db.HOME_CACHE.stats()
+    )
     
 
 
@@ -616,6 +810,14 @@ def get_profile_image():
     return redirect(url_for("image_url", userID=session.get("userID")))
 
 
+# Profile tabs -> page fetch (userID, after=cursor, cur=None) -> (recipes, next cursor)
+PROFILE_TABS = {
+    "posts": db.get_user_posts,
+    "saved": lambda userID, **kwargs: db.get_user_interactions(userID, saved=True, **kwargs),
+    "drafts": db.get_user_drafts
+}
+
+
 @app.route("/profile")
 def profile():
     
@@ -626,22 +828,76 @@ def profile():
     
     userID = session.get('userID')
     # Reuse cursor with a few calls
+    # Each tab pages on its own, ?posts=<cursor>&saved=<cursor>&drafts=<cursor>
     with db.get_db_cursor(commit=False) as cur:
 
-        saved_recipes = db.get_user_interactions(userID, saved=True, cur=cur)
-        user_posts = db.get_user_posts(userID, cur=cur)
-        user_drafts = db.get_user_drafts(userID=userID, cur=cur)
+        pages = {}
+        for tab, fetch in PROFILE_TABS.items():
+            try:
+                pages[tab] = fetch(userID, after=request.args.get(tab), cur=cur)
+            except ValueError:
+                pages[tab] = fetch(userID, cur=cur)
+
+        # "More" links keep the other tabs where they are
+        next_links = {
+            tab: url_for("profile", **(request.args.to_dict() | {tab: cursor})) if cursor else None
+            for tab, (_, cursor) in pages.items()
+        }
 
         return render_template(
             "profile.html",
             user=True,
             session=session.get('user'),
-            user_posts=user_posts,
-            saved_recipes=saved_recipes,
-            user_drafts=user_drafts
+            user_posts=pages["posts"][0],
+            saved_recipes=pages["saved"][0],
+            user_drafts=pages["drafts"][0],
+            next_links=next_links
         )
 
 
+## CLI ##
+
+
+# flask --app app recompute-nutrition
+@app.cli.command("recompute-nutrition")
+def recompute_nutrition_command():
+    """Recompute stored nutrition totals for every recipe."""
+    print(f"Updated {db.recompute_nutrition()} recipes")
+
+
+# flask --app app rebuild-stats
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """Rebuild the RecipeStats rating / save / comment counters."""
+    print(f"Rebuilt stats for {db.rebuild_recipe_stats()} recipes")
+
+
+# flask --app app refresh-trending [--full]
+# The web processes already run this every TRENDING_REFRESH_SECONDS, each run only rescores
+#   recipes with new activity
+@app.cli.command("refresh-trending")
+@click.option("--full", is_flag=True, help="Rescore every recipe, not just ones with new activity.")
+def refresh_trending_command(full):
+    """Update the time-decayed trending scores behind the home page trending row."""
+    count = db.refresh_trending(full=full)
+    print("A refresh is already running" if count == None else f"Rescored {count} recipes")
+
+
+# flask --app app migrate
+@app.cli.command("migrate")
+def migrate_command():
+    """Apply pending schema migrations from migrations/."""
+    print(f"Applied {len(migrate.migrate())} migrations")
+
+
+# flask --app app check-plans
+@app.cli.command("check-plans")
+def check_plans_command():
+    """EXPLAIN the canonical db.py queries, exit 1 if any needs a sequential scan."""
+    if migrate.check_plans():
+        raise SystemExit(1)
+
+
 ## Execute Server ##
 
 
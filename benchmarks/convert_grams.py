@@ -0,0 +1,60 @@
+## Micro benchmark, convert_grams table lookup vs the old per-call pint parsing
+## python benchmarks/convert_grams.py   (run from the repo root)
+
+import os
+import sys
+import timeit
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("USDA_CACHE_PATH", "")
+
+from recipeUtil import UREG, DENSITIES, convert_grams
+
+
+# convert_grams before the unit table
+def convert_grams_pint(amount, category=""):
+    if amount == None:
+        return None
+    unitName = f"{amount.unit}".lower()
+    if unitName not in UREG:
+        return None
+    if UREG(unitName).check("[mass]"):
+        grams = (float(amount.quantity) * UREG(unitName)).to("gram").magnitude
+    elif UREG(unitName).check("[volume]"):
+        density = DENSITIES.get(category)
+        density = (density[0] if density else 1) * UREG("gram / milliliter")
+        volume = float(amount.quantity) * UREG(unitName)
+        grams = (volume * density).to("gram").magnitude
+    else:
+        grams = 0
+    return round(grams, 2)
+
+
+AMOUNTS = [
+    SimpleNamespace(quantity=2, unit="cup"),
+    SimpleNamespace(quantity=1.5, unit="tablespoon"),
+    SimpleNamespace(quantity=8, unit="ounce"),
+    SimpleNamespace(quantity=1, unit="stick"),
+    SimpleNamespace(quantity=3, unit="clove"),
+]
+CATEGORY = "Dairy and Egg Products"
+
+
+def run(fn):
+    for amount in AMOUNTS:
+        fn(amount, CATEGORY)
+
+
+if __name__ == "__main__":
+    for amount in AMOUNTS:
+        old, new = convert_grams_pint(amount, CATEGORY), convert_grams(amount, CATEGORY)
+        assert old == new, f"{amount} - pint {old} != table {new}"
+
+    number = 200
+    old = min(timeit.repeat(lambda: run(convert_grams_pint), number=number, repeat=5))
+    new = min(timeit.repeat(lambda: run(convert_grams), number=number, repeat=5))
+    calls = number * len(AMOUNTS)
+    print(f"pint parsing: {old / calls * 1e6:8.2f} us / call")
+    print(f"unit table:   {new / calls * 1e6:8.2f} us / call")
+    print(f"speedup:      {old / new:8.1f}x")
@@ -0,0 +1,96 @@
+## Benchmark, get_recipes random sampling vs the old ORDER BY RANDOM() as the table grows
+## DATABASE_URL=... python benchmarks/random_sample.py   (run from the repo root)
+##   Runs the migrations in a scratch schema (bench_random), dropped again at the end
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import migrate
+from dbPool import ConnectionPool
+
+SCHEMA = "bench_random"
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+LIMIT = 6
+RUNS = 50
+
+# get_recipes before randkey sampling (home page "trending" row)
+OLD_QUERY = """
+    WITH ratings AS (
+        SELECT recipeid, AVG(rating) AS avg_rating, COUNT(rating) AS ratings, SUM(saved::int) AS saves
+        FROM interactions GROUP BY recipeid
+    ),
+    tags AS (
+        SELECT tm.recipeid, array_agg(DISTINCT t.name) AS tags
+        FROM tagMatch tm JOIN tags t ON tm.tagid = t.tagid
+        GROUP BY tm.recipeid
+    )
+    SELECT r.*, t.tags, u.username AS author, avg_rating, ratings, saves
+    FROM recipes r
+    LEFT JOIN tags t ON t.recipeid = r.recipeid
+    LEFT JOIN ratings rr ON rr.recipeid = r.recipeid
+    JOIN users u ON u.userid = r.userid
+    WHERE r.draft = false
+    ORDER BY RANDOM() LIMIT %s
+"""
+
+
+def grow(cur, total):
+    cur.execute("SELECT COUNT(*) FROM recipes")
+    have = cur.fetchone()[0]
+    cur.execute("""
+        INSERT INTO recipes (userid, draft, servings, title, brief, steps, ingredients)
+        SELECT 1, i %% 10 = 0, 4, 'Recipe ' || i, 'Benchmark recipe', '[]', '[]'
+        FROM generate_series(%s, %s) i
+    """, (have + 1, total))
+    cur.execute("""
+        INSERT INTO tagMatch (recipeid, tagid)
+        SELECT recipeid, 1 + recipeid %% 45 FROM recipes WHERE recipeid > %s
+    """, (have,))
+    cur.execute("""
+        INSERT INTO interactions (recipeid, userid, rating, saved)
+        SELECT recipeid, 1, 1 + recipeid %% 5, recipeid %% 3 = 0 FROM recipes WHERE recipeid > %s
+    """, (have,))
+    cur.execute("ANALYZE")
+
+
+def timed(fn):
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2] * 1000
+
+
+if __name__ == "__main__":
+    dsn = os.environ["DATABASE_URL"]
+    db.pool = ConnectionPool(1, 2, dsn=dsn, options=f"-c search_path={SCHEMA}")
+
+    with db.get_db_cursor(commit=True) as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}")
+    migrate.migrate()
+    with db.get_db_cursor(commit=True) as cur:
+        cur.execute("INSERT INTO users (oauthid, oauthprovider, username) VALUES ('bench', 'bench', 'bench')")
+
+    try:
+        print(f"{'recipes':>10} {'ORDER BY RANDOM()':>18} {'randkey':>10} {'randkey+tag':>12}  (median ms)")
+        for size in SIZES:
+            with db.get_db_cursor(commit=True) as cur:
+                grow(cur, size)
+
+            def old():
+                with db.get_db_cursor() as cur:
+                    cur.execute(OLD_QUERY, (LIMIT,))
+                    cur.fetchall()
+
+            new = timed(lambda: db.get_recipes(limit=LIMIT))
+            tagged = timed(lambda: db.get_recipes(limit=LIMIT, tags=[9], minAvgRating=3))
+            print(f"{size:>10} {timed(old):>18.2f} {new:>10.2f} {tagged:>12.2f}")
+    finally:
+        with db.get_db_cursor(commit=True) as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
@@ -0,0 +1,249 @@
+## Small caching helpers
+## In-process LRU (optional TTL) with an optional SQLite store behind it
+##   LRU is per process, SQLite file is shared by every gunicorn worker on a host
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# Normalize free text so "2 Cups  Flour" and "2 cups flour" share an entry
+def normalize_key(text):
+    return " ".join(f"{text}".lower().split())
+
+
+# Thread safe LRU, entries expire after ttl seconds (None = never)
+class LRUCache:
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.time():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[0] if item else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+
+# Key/value store in a local SQLite file, values stored as json text
+# maxrows is enforced every PRUNE_EVERY writes, so the table may run that far over between prunes
+class SQLiteStore:
+
+    PRUNE_EVERY = 100
+
+    def __init__(self, path, table="cache", maxrows=None):
+        self.path = path
+        self.table = table
+        self.maxrows = maxrows
+        self._writes = 0
+        self._writesLock = threading.Lock()
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)"
+            )
+
+    # One connection per thread, sqlite connections can not be shared
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        row = conn.execute(
+            f"SELECT value, expires FROM {self.table} WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires is not None and expires <= time.time():
+            with conn:
+                conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            return None
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl is not None else None
+        with self._connect() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires)
+            )
+            # Size cap, drop whatever expires soonest (entries that never expire go last)
+            if self.maxrows and self._prune_due():
+                conn.execute(
+                    f"DELETE FROM {self.table} WHERE key IN ("
+                    f"SELECT key FROM {self.table} ORDER BY expires IS NULL, expires "
+                    f"LIMIT max(0, (SELECT count(*) FROM {self.table}) - ?))",
+                    (self.maxrows,)
+                )
+
+    # Count the table only every PRUNE_EVERY writes, count(*) is a full scan in SQLite
+    def _prune_due(self):
+        with self._writesLock:
+            self._writes += 1
+            return self._writes % self.PRUNE_EVERY == 0
+
+    # Drop expired rows, returns number removed
+    def purge(self):
+        with self._connect() as conn:
+            cur = conn.execute(
+                f"DELETE FROM {self.table} WHERE expires IS NOT NULL AND expires <= ?",
+                (time.time(),)
+            )
+            return cur.rowcount
+
+
+# LRU in front of an (optional) SQLite store
+# Store failures are logged and treated as misses, a cache should never break a lookup
+class TieredCache:
+
+    def __init__(self, path=None, table="cache", maxsize=1024, ttl=None, maxrows=None):
+        self.ttl = ttl
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.store = None
+        self.store_hits = 0
+        self.misses = 0
+        if path:
+            try:
+                self.store = SQLiteStore(path, table=table, maxrows=maxrows)
+            except sqlite3.Error as e:
+                print(f"Cache store disabled ({path}) - {e}")
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        if self.store is not None:
+            try:
+                value = self.store.get(key)
+            except sqlite3.Error as e:
+                print(f"Cache store read failed - {e}")
+                value = None
+            if value is not None:
+                self.store_hits += 1
+                self.memory.set(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.store is not None:
+            try:
+                self.store.set(key, value, ttl=self.ttl)
+            except sqlite3.Error as e:
+                print(f"Cache store write failed - {e}")
+
+    def stats(self):
+        memory = self.memory.stats()
+        hits = memory["hits"] + self.store_hits
+        total = hits + self.misses
+        return {
+            "memory": memory,
+            "store": self.store.path if self.store is not None else None,
+            "store_hits": self.store_hits,
+            "hits": hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0
+        }
+
+
+# Collapse concurrent calls for the same key into one
+# First caller runs fn, everyone arriving while it runs waits and gets the same result (or error)
+class SingleFlight:
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            self.calls += 1
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = {"done": threading.Event()}
+            else:
+                self.shared += 1
+
+        if not leader:
+            call["done"].wait()
+            if "error" in call:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call["done"].set()
+
+    def stats(self):
+        return {"calls": self.calls, "shared": self.shared, "inflight": len(self._inflight)}
+
+
+# Read an int/float setting from the environment
+def env_number(name, default, cast=int):
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    return cast(value)
@@ -9,18 +9,34 @@ docs:
 * http://initd.org/psycopg/docs/extras.html#dictionary-like-cursor
 """
 
+import base64
 from contextlib import contextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+import json
 import logging
+import math
 import os
+import random as rng
+import re
+import threading
+import time
 from typing import override
 
-from flask import current_app, g
+from flask import current_app, g, has_app_context, has_request_context, session
 
-# import psycopg2
-from psycopg2.pool import ThreadedConnectionPool
+import psycopg2
+import psycopg2.extensions
 from psycopg2.extras import DictCursor, execute_values, Json
+from psycopg2.pool import PoolError
+
+from cache import LRUCache, SingleFlight, env_number
+from dbPool import ConnectionPool, Histogram, ReplicaSet
+import nutrients
 
 pool = None
+replicas = None
 
 # Dictionary of tags to tagIDs on the database
 #   (Small enough to hardcode)
@@ -76,35 +92,161 @@ tags = {
 ## General database
 
 
+def _make_pool(dsn, minconn):
+    return ConnectionPool(
+        minconn=minconn,
+        maxconn=env_number("DB_POOL_MAX", 100),
+        timeout=env_number("DB_POOL_TIMEOUT", 5, float),                # seconds to wait for a free connection
+        maxAge=env_number("DB_POOL_MAX_AGE", 30 * 60, float),           # seconds before a connection is replaced
+        checkAfter=env_number("DB_POOL_CHECK_AFTER", 30, float),        # idle seconds before a ping on reuse
+        statementTimeout=env_number("DB_STATEMENT_TIMEOUT", 15000),     # ms, 0 = no limit
+        dsn=dsn,
+        sslmode="require"
+    )
+
+
 def setup():
-    global pool
+    global pool, replicas
     DATABASE_URL = os.environ["DATABASE_URL"]
     # current_app.logger.info(f"creating db connection pool")
-    pool = ThreadedConnectionPool(1, 100, dsn=DATABASE_URL, sslmode="require")
+    pool = _make_pool(DATABASE_URL, env_number("DB_POOL_MIN", 2))
+    pool.prewarm()
+
+    # Optional read replicas, comma separated DSNs
+    replicaURLs = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+    if len(replicaURLs) > 0:
+        replicas = ReplicaSet(
+            [_make_pool(url, env_number("DB_REPLICA_POOL_MIN", 1)) for url in replicaURLs],
+            maxLag=env_number("DB_REPLICA_MAX_LAG", 5, float),
+            checkEvery=env_number("DB_REPLICA_LAG_CHECK", 5, float)
+        )
+        for replicaPool in replicas.pools:
+            replicaPool.prewarm()
 
 
+# Register the per request connection teardown
+def init_app(app):
+    app.teardown_appcontext(close_db)
+
+
+# Reads stay on the primary for the rest of a request that wrote, and for STICKY_SECONDS
+#   in that user's session, so they see their own rating / comment before replicas catch up
+STICKY_SECONDS = env_number("DB_STICKY_SECONDS", 10, float)
+
+def _stuck_to_primary():
+    if has_app_context() and g.get("db_wrote"):
+        return True
+    return has_request_context() and session.get("dbPrimaryUntil", 0) > time.time()
+
+def _mark_write():
+    if has_app_context():
+        g.db_wrote = True
+    if has_request_context() and replicas != None:
+        session["dbPrimaryUntil"] = time.time() + STICKY_SECONDS
+
+
+# Pool a call should use: a replica for reads when one is configured, usable and not stuck
+def _choose_pool(readonly):
+    if not readonly or replicas == None or _stuck_to_primary():
+        return pool
+    if has_app_context() and "db_replica" in g:
+        return g.db_replica[0]
+    return replicas.choose() or pool
+
+
+# Check out from source, falling back to the primary if a replica is unreachable or busy
+# primary is a primary connection already held (the request's), reused instead of a new checkout
+# Only a failed connect marks the replica down, a full pool just means it is busy
+def _checkout(source, primary=None):
+    if source is pool:
+        return pool, primary or pool.getconn()
+    try:
+        return source, source.getconn()
+    except psycopg2.OperationalError as e:
+        print(f"Replica unavailable, reading from primary - {e}")
+        replicas.mark_down(source)
+    except PoolError as e:
+        print(f"Replica pool busy, reading from primary - {e}")
+    return pool, primary or pool.getconn()
+
+
+# Inside a request (or app context) every db call shares one connection (one primary,
+#   one replica), checked out on first use and returned by close_db, so a page costs one
+#   pool checkout per database
+# Outside one (background threads, scripts) each call checks out its own
+# readonly calls may be served by a replica, see _choose_pool
 @contextmanager
-def get_db_connection():
+def get_db_connection(readonly=False):
+    source = _choose_pool(readonly)
+
+    if has_app_context():
+        if source is pool and "db_connection" in g:
+            connection = g.db_connection
+        elif source is not pool and "db_replica" in g:
+            connection = g.db_replica[1]
+        else:
+            source, connection = _checkout(source, g.get("db_connection"))
+            if source is pool:
+                g.db_connection = connection
+            else:
+                g.db_replica = (source, connection)
+
+        # Blocks can nest on the shared connection (a read inside a write), only the outermost
+        #   one ends the transaction
+        depth = g.setdefault("db_depth", {})
+        depth[id(connection)] = depth.get(id(connection), 0) + 1
+        try:
+            yield connection
+        except Exception:
+            # Leave the shared connection usable for the rest of the request
+            connection.rollback()
+            raise
+        finally:
+            depth[id(connection)] -= 1
+            # Writes have committed by now, end what is left (reads) so the session is not
+            #   left idle in transaction through slow work later in the request
+            if depth[id(connection)] == 0 and not connection.closed and \
+                    connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        return
+
+    source, connection = _checkout(source)
     try:
-        connection = pool.getconn()
         yield connection
     finally:
-        pool.putconn(connection)
+        source.putconn(connection)
+
+
+# Return the request's connections to their pools
+# Writes commit themselves (get_db_cursor(commit=True)), anything still open is reads
+#   or a failed request, so it is rolled back like the pool does on putconn
+def close_db(exception=None):
+    held = [(pool, g.pop("db_connection", None)), g.pop("db_replica", (None, None))]
+    for source, connection in held:
+        if connection == None:
+            continue
+        try:
+            if not connection.closed:
+                connection.rollback()
+        finally:
+            source.putconn(connection, close=bool(connection.closed))
 
 
 # Pass cur to allow the same cursor to be used
 ## NOTE if a commit is required, first cur init in chain must be True
+##   (commit=False cursors may be on a read replica)
 @contextmanager
 def get_db_cursor(commit=False, cur=None):
     if cur != None:
         yield cur
     else:
-        with get_db_connection() as connection:
+        with get_db_connection(readonly=not commit) as connection:
             cursor = connection.cursor(cursor_factory=DictCursor)
             try:
                 yield cursor
                 if commit:
                     connection.commit()
+                    _mark_write()
             finally:
                 cursor.close()
 
@@ -219,114 +361,338 @@ def submit_recipe(recipe, recipeID=None, imageFile=None, imageLink=None, cur=Non
         # string {amount-[asdf, asdf, asdf]} nutrients index according to 
         # NUTRIENTS = ['Protein (g)', 'Total Fat (g)', 'Carbohydrates (g)', 'Sugars (g)', 'Fiber (g)', 'Calcium (mg)', 'Iron (mg)', 'Potassium (mg)', 'Sodium (mg)', 'Vitamin A (µg)', 'Vitamin C (mg)', 'Cholesterol (mg)', 'Trans Fat (g)', 'Saturated Fat (g)']
 
-        # Return recipeID
-        return recipeID
+    invalidate_home_feed()
+    # Return recipeID
+    return recipeID
 
 
-## THE ALMIGHTY get recipes query
-## has an input for practically any option in filtering
-def get_recipes(recipeIDs=[], userIDs=[], tags=[], titleTerms=[], 
-                minAvgRating=None, minRatings=None, isDraft=False,
-                limit=1, random=True, recent=False, cur=None
-    ):
+# Insert many recipes at once (bulk ingest), one statement per table
+# recipes are dicts shaped like submit_recipe's, plus an optional "image_url"
+# Returns the new recipeIDs in input order
+def bulk_insert_recipes(recipes, cur=None):
+    if len(recipes) == 0:
+        return []
+
+    with get_db_cursor(commit=True, cur=cur) as cur:
+        recipeIDs = [row[0] for row in execute_values(cur, """
+            INSERT INTO recipes (
+                userID, draft, servings, cooktime, kcal, title, brief, comment, link, steps, ingredients, nutrients, lastEdit
+            ) VALUES %s
+            RETURNING recipeID
+            """,
+            [
+                (
+                    recipe.get("userID"), bool(recipe.get("draft")), recipe.get("servings"), recipe.get("cooktime"),
+                    recipe.get("kcal"), recipe.get("title"), recipe.get("brief"), recipe.get("comment"),
+                    recipe.get("link"), Json(recipe.get("steps")), Json(recipe.get("ingredients")), Json(recipe.get("nutrients"))
+                )
+                for recipe in recipes
+            ],
+            template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())",
+            page_size=1000,
+            fetch=True
+        )]
+
+        tagRows = [
+            (recipeID, tags[tag])
+            for recipeID, recipe in zip(recipeIDs, recipes)
+            for tag in set(recipe.get("tags") or []) if tag in tags
+        ]
+        execute_values(cur, "INSERT INTO tagMatch (recipeID, tagID) VALUES %s", tagRows, page_size=1000)
+
+        imageRows = [
+            (recipeID, recipe.get("userID"), f"Recipe {recipeID} image", recipe.get("image_url"))
+            for recipeID, recipe in zip(recipeIDs, recipes) if recipe.get("image_url")
+        ]
+        execute_values(cur, "INSERT INTO images (recipeID, userID, title, link) VALUES %s", imageRows, page_size=1000)
 
+        return recipeIDs
+
+
+# Links (of the given ones) that are already stored
+def get_existing_links(links, cur=None):
+    if len(links) == 0:
+        return set()
     with get_db_cursor(commit=False, cur=cur) as cur:
-        
-        query = "SELECT * FROM recipes r"
-        queryData = []
-        andFlag = False
-
-        # Helper to add AND or WHERE
-        def andWhere(toAdd, addAnd):
-            if addAnd:
-                return " AND" + toAdd
-            else:
-                return " WHERE" + toAdd
+        cur.execute("SELECT DISTINCT link FROM recipes WHERE link = ANY(%s)", (list(links),))
+        return set(row[0] for row in cur.fetchall())
 
-        # Prep tag filtering
-        tagFilter = False
-        if len(tags) > 0:
-            tagFilter = True
-            queryData.append(tags)
 
-        # Start base query with filter
-        query = f"""
-            WITH ratings AS (
-                SELECT recipeid, 
-                    AVG(rating) AS avg_rating,
-                    COUNT(rating) AS ratings, 
-                    SUM(saved::int) AS saves
-                FROM interactions GROUP BY recipeid
-            ),
-            tags AS (
-                {"""
-                WITH tagMatches AS (
-                    SELECT DISTINCT tm.recipeid
-                    FROM tagMatch tm
-                    WHERE tm.tagid = ANY(%s)
-                )
-                """ if tagFilter else ""
-                }
-                SELECT tm.recipeid, array_agg(DISTINCT t.name) AS tags
-                FROM tagMatch tm
-                {"JOIN tagMatches tms ON tms.recipeid = tm.recipeid" if tagFilter else ""}
-                JOIN tags t ON tm.tagid = t.tagid
-                GROUP BY tm.recipeid  
-            )
-            SELECT r.*, t.tags, u.username AS author, avg_rating, ratings, saves
-            FROM recipes r 
-            {"LEFT" if not tagFilter else ""} JOIN tags t ON t.recipeid = r.recipeid
-            LEFT JOIN ratings rr ON rr.recipeid = r.recipeid
-            JOIN users u ON u.userid = r.userid
+# Recipe columns returned to callers (leaves out randkey / search_doc, which only serve indexes)
+RECIPE_COLUMNS = ", ".join(f"r.{col}" for col in [
+    "recipeid", "userid", "draft", "servings", "cooktime", "kcal", "title", "brief",
+    "comment", "link", "lastedit", "steps", "ingredients", "nutrients"
+])
+
+
+# Keyed get_recipes orderings: name -> (sort expression, type its cursor value is cast back to)
+# All sort descending with recipeid as the tie breaker
+ORDERINGS = {
+    "recent": ("r.lastedit", "timestamp"),
+    "id": ("r.recipeid", "int"),
+    "rating": ("COALESCE(rs.avg_rating, 0)", "numeric"),
+    "rank": ("ts_rank(r.search_doc, websearch_to_tsquery('english', %(search)s)) + word_similarity(%(search)s, r.title)", "real"),
+    "trending": ("r.trending_score", "float8")
+}
+
+
+# get_recipes filters, in WHERE clause order (saved / ratings narrow interactedBy's EXISTS)
+RECIPE_FILTERS = {
+    # <% matches the query against the closest stretch of words in the title, not the whole
+    #   title, so a typo still finds "Creamy Chicken Soup" (served by recipes_title_trgm_idx)
+    "search": "(r.search_doc @@ websearch_to_tsquery('english', %(search)s) OR %(search)s <%% r.title)",
+    "tags": "EXISTS (SELECT 1 FROM tagMatch tf WHERE tf.recipeid = r.recipeid AND tf.tagid = ANY(%(tags)s))",
+    "interactedBy": "EXISTS (SELECT 1 FROM interactions i WHERE i.recipeid = r.recipeid AND i.userid = %(interactedBy)s{saved}{ratings})",
+    "saved": " AND i.saved = %(saved)s",
+    "ratings": " AND i.rating = ANY(%(ratings)s)",
+    "recipeIDs": "r.recipeID = ANY(%(recipeIDs)s)",
+    "isDraft": "r.draft = %(isDraft)s",
+    "userIDs": "r.userID = ANY(%(userIDs)s)",
+    "links": "r.link = ANY(%(links)s)",
+    "titleTerms": "r.title ILIKE ANY(%(titleTerms)s)",
+    "minAvgRating": "rs.avg_rating >= %(minAvgRating)s",
+    "minRatings": "rs.rating_count > %(minRatings)s"
+}
+
+
+# SQL for one get_recipes shape: which filters are set, the order and whether it continues
+#   from a cursor. Values are named parameters, so the text only depends on the shape
+#   and is built once per process
+@lru_cache(maxsize=None)
+def _recipes_sql(filters, order, paged):
+    keyed = order in ORDERINGS
+    sortKey, cast = ORDERINGS.get(order, (None, None))
+
+    # Tags are gathered per returned row so nothing here aggregates the whole tagMatch table
+    query = f"""
+        SELECT {f"{sortKey} AS sortkey, " if keyed else ""}{RECIPE_COLUMNS}, t.tags, u.username AS author,
+            rs.avg_rating, rs.rating_count AS ratings, rs.save_count AS saves, rs.comment_count
+        FROM recipes r
+        LEFT JOIN LATERAL (
+            SELECT array_agg(DISTINCT tg.name) AS tags
+            FROM tagMatch tm
+            JOIN tags tg ON tg.tagid = tm.tagid
+            WHERE tm.recipeid = r.recipeid
+        ) t ON TRUE
+        LEFT JOIN recipeStats rs ON rs.recipeid = r.recipeid
+        JOIN users u ON u.userid = r.userid
+    """
+
+    where = []
+    for name in filters:
+        if name == "interactedBy":
+            where.append(RECIPE_FILTERS[name].format(
+                saved=RECIPE_FILTERS["saved"] if "saved" in filters else "",
+                ratings=RECIPE_FILTERS["ratings"] if "ratings" in filters else ""
+            ))
+        elif name not in ("saved", "ratings"):
+            where.append(RECIPE_FILTERS[name])
+
+    def whereSQL(extra=[]):
+        clauses = where + extra
+        return " WHERE " + " AND ".join(clauses) if clauses else ""
+
+    # Random sample without sorting every match:
+    #   walk the randkey index up from a random pivot, wrap around to the start if short
+    if order == "random":
+        return f"""
+            ({query}{whereSQL(["r.randkey >= %(pivot)s"])} ORDER BY r.randkey LIMIT %(limit)s)
+            UNION ALL
+            ({query}{whereSQL(["r.randkey < %(pivot)s"])} ORDER BY r.randkey LIMIT %(limit)s)
+            LIMIT %(limit)s
         """
 
-        # Build a filter for each input
-        if len(recipeIDs) > 0:
-            query += andWhere(" r.recipeID = ANY(%s)", andFlag)
-            queryData.append(recipeIDs)
-            andFlag = True
-
-        if isDraft != None:
-            query += andWhere(" r.draft = %s", andFlag)
-            queryData.append(isDraft)
-            andFlag = True
-
-        if len(userIDs) > 0:
-            query += andWhere(" r.userID = ANY(%s)", andFlag)
-            queryData.append(userIDs)
-            andFlag = True
-
-        if len(titleTerms) > 0:
-            query += andWhere(" r.title ILIKE ANY(%s)", andFlag)
-            queryData.append([f"%{item}%" for item in titleTerms])
-            andFlag = True
-
-        if minAvgRating != None:
-            query += andWhere(" avg_rating >= %s", andFlag)
-            queryData.append(minAvgRating)
-            andFlag = True
-
-        if minRatings != None:
-           query += andWhere(" ratings > %s", andFlag)
-           queryData.append(minRatings) 
-
-        if random:
-            query += " ORDER BY RANDOM()"
+    # Keyed order, newest / best first with recipeid breaking ties
+    #   a cursor continues strictly after its row, so deep pages cost the same as the first
+    if keyed:
+        after = [f"({sortKey}, r.recipeid) < (%(afterValue)s::{cast}, %(afterID)s)"] if paged else []
+        return query + whereSQL(after) + " ORDER BY sortkey DESC, r.recipeid DESC LIMIT %(limit)s OFFSET %(offset)s"
+
+    return query + whereSQL() + " LIMIT %(limit)s OFFSET %(offset)s"
+
+
+# Shape SQL rewritten for PREPARE: %(name)s -> $n, returns (sql, parameter names in $ order)
+@lru_cache(maxsize=None)
+def _prepared_sql(sql):
+    names = []
+    def number(match):
+        if match.group(1) == None:
+            return "%"
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f"${names.index(match.group(1)) + 1}"
+    return re.sub(r"%\((\w+)\)s|%%", number, sql), names
+
+
+# Shapes run this often (in this process) are prepared on each connection that runs them,
+#   later calls on that connection skip parsing and planning. 0 turns prepared statements off
+#   (needed behind a transaction mode pgbouncer, where sessions are not kept)
+PREPARE_AFTER = env_number("DB_PREPARE_AFTER", 3)
+
+# Per shape stats, shape -> {"name", "calls", "prepared", "ms"}
+_shapes = {}
+_shapesLock = threading.Lock()
+
+
+# Run one get_recipes shape, as a prepared statement once it is hot and cur's connection
+#   tracks what it has prepared (pooled connections do, stand in cursors like migrate's do not)
+def _execute_shape(cur, shape, params):
+    sql = _recipes_sql(*shape)
+    with _shapesLock:
+        stats = _shapes.get(shape)
+        if stats == None:
+            stats = _shapes[shape] = {"name": f"recipes_{len(_shapes) + 1}", "calls": 0, "prepared": 0, "ms": Histogram()}
+        stats["calls"] += 1
+        hot = PREPARE_AFTER > 0 and stats["calls"] >= PREPARE_AFTER
+
+    prepared = getattr(getattr(cur, "connection", None), "prepared", None)
+    usePrepared = hot and prepared != None
+    start = time.perf_counter()
+    if usePrepared:
+        text, names = _prepared_sql(sql)
+        if stats["name"] not in prepared:
+            cur.execute(f"PREPARE {stats['name']} AS {text}")
+            prepared.add(stats["name"])
+        cur.execute(f"EXECUTE {stats['name']} ({', '.join(f'%({name})s' for name in names)})", params)
+    else:
+        cur.execute(sql, params)
+    res = cur.fetchall()
+
+    with _shapesLock:
+        stats["ms"].observe((time.perf_counter() - start) * 1000)
+        if usePrepared:
+            stats["prepared"] += 1
+    return res
+
+
+# get_recipes shapes seen by this process, most called first
+def query_stats():
+    with _shapesLock:
+        shapes = sorted(_shapes.items(), key=lambda item: -item[1]["calls"])
+        return [
+            {
+                "name": stats["name"],
+                "filters": list(filters),
+                "order": order,
+                "paged": paged,
+                "calls": stats["calls"],
+                "prepared_calls": stats["prepared"],
+                "ms": stats["ms"].stats()
+            }
+            for (filters, order, paged), stats in shapes
+        ]
+
+
+# Opaque page cursor: the last row's sort value and recipeid
+# Values travel as text (exact for timestamps / numerics) and are cast back in SQL
+def encode_cursor(order, row):
+    value = row["sortkey"]
+    value = value.isoformat() if hasattr(value, "isoformat") else repr(value) if isinstance(value, float) else f"{value}"
+    payload = json.dumps([order, value, row["recipeid"]]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+# Cursor text back to a value of the ordering's SQL type, so a tampered cursor fails
+#   here instead of as a cast error inside the query
+CURSOR_PARSERS = {
+    "timestamp": datetime.fromisoformat,
+    "int": int,
+    "numeric": Decimal,
+    "real": float,
+    "float8": float
+}
+
+
+# Raises ValueError for a malformed cursor or one from a different ordering
+def decode_cursor(cursor, order):
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursorOrder, value, recipeID = json.loads(payload)
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid page cursor") from e
+    if cursorOrder != order or not isinstance(recipeID, int) or not isinstance(value, str):
+        raise ValueError("Invalid page cursor")
+    try:
+        value = CURSOR_PARSERS[ORDERINGS[order][1]](value)
+    except (KeyError, ValueError, InvalidOperation) as e:
+        raise ValueError("Invalid page cursor") from e
+    # NaN / infinity never come out of encode_cursor
+    if isinstance(value, float) and not math.isfinite(value) or isinstance(value, Decimal) and not value.is_finite():
+        raise ValueError("Invalid page cursor")
+    return value, recipeID
+
+
+## THE ALMIGHTY get recipes query
+## has an input for practically any option in filtering
+## search is ranked full text (title > brief > ingredients > steps) plus fuzzy title matches
+## interactedBy limits to recipes a user saved (saved=True) / rated (ratings=[...])
+## order is one of ORDERINGS, default "rank" for a search, else random / recent / unordered
+##   keyed orders page with after=<cursor from get_recipes_page>
+## The SQL is built once per shape of filters (see _recipes_sql) and prepared when hot
+def get_recipes(recipeIDs=[], userIDs=[], tags=[], titleTerms=[], links=[],
+                minAvgRating=None, minRatings=None, isDraft=False, search=None,
+                interactedBy=None, saved=None, ratings=[],
+                limit=1, offset=0, random=True, recent=False, order=None, after=None, cur=None
+    ):
+
+    # Resolve ordering, keyed orders also return their sort value (for cursors)
+    if order == None:
+        if search:
+            order = "rank"
+        elif random:
+            order = "random"
         elif recent:
-            query += " ORDER BY r.lastedit"
-        query += " LIMIT %s"
-        queryData.append(limit)
+            order = "recent"
+    if order != "random" and order not in ORDERINGS:
+        order = None
+
+    # Which filters are set, in RECIPE_FILTERS order
+    present = {
+        "search": bool(search),
+        "tags": len(tags) > 0,
+        "interactedBy": interactedBy != None,
+        "saved": interactedBy != None and saved != None,
+        "ratings": interactedBy != None and len(ratings) > 0,
+        "recipeIDs": len(recipeIDs) > 0,
+        "isDraft": isDraft != None,
+        "userIDs": len(userIDs) > 0,
+        "links": len(links) > 0,
+        "titleTerms": len(titleTerms) > 0,
+        "minAvgRating": minAvgRating != None,
+        "minRatings": minRatings != None
+    }
+    filters = tuple(name for name in RECIPE_FILTERS if present[name])
+
+    params = {
+        "search": search, "tags": tags, "interactedBy": interactedBy, "saved": saved, "ratings": ratings,
+        "recipeIDs": recipeIDs, "isDraft": isDraft, "userIDs": userIDs, "links": links,
+        "titleTerms": [f"%{item}%" for item in titleTerms],
+        "minAvgRating": minAvgRating, "minRatings": minRatings,
+        "limit": limit, "offset": offset
+    }
+    if order == "random":
+        params["pivot"] = rng.random()
+    paged = order in ORDERINGS and after != None
+    if paged:
+        params["afterValue"], params["afterID"] = decode_cursor(after, order)
 
-        # Execute and return
-        # print(query % tuple(queryData))
-        cur.execute(query, tuple(queryData))
-        res = cur.fetchall()
+    with get_db_cursor(commit=False, cur=cur) as cur:
+        res = _execute_shape(cur, (filters, order, paged), params)
 
         return [ 
             dict(row) | {"image_url":f"/api/image?recipeID={row.get("recipeid", "")}"} for row in res 
         ]
 
     
+# One page of get_recipes in a keyed order
+# Returns (recipes, cursor for the next page or None on the last page)
+def get_recipes_page(limit=20, order="recent", after=None, cur=None, **filters):
+    rows = get_recipes(limit=limit + 1, order=order, after=after, cur=cur, **filters)
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(order, rows[limit - 1])
+    return rows, None
+
+
 # Wrapper for singular recipe
 def get_recipe(recipeID, cur=None):
     res = get_recipes(recipeIDs=[recipeID], random=False, isDraft=None, limit=1, cur=cur)
@@ -334,15 +700,276 @@ def get_recipe(recipeID, cur=None):
         return res[0]
     return None
 
-# Wrapper for user drafts
-def get_user_drafts(userID, cur=None):
-    return get_recipes(userIDs=[userID], random=False, isDraft=True, limit=99, cur=cur)
+# Wrapper for a published recipe imported from any of links
+def get_recipe_by_link(links, cur=None):
+    links = [link for link in links if link]
+    if len(links) == 0:
+        return None
+    res = get_recipes(links=links, random=False, recent=True, limit=1, cur=cur)
+    if len(res) > 0:
+        return res[0]
+    return None
+
+# Wrapper for user drafts, newest first, returns (recipes, next cursor)
+def get_user_drafts(userID, limit=24, after=None, cur=None):
+    return get_recipes_page(userIDs=[userID], isDraft=True, limit=limit, after=after, cur=cur)
+
+# wrapper for user posts, newest first, returns (recipes, next cursor)
+def get_user_posts(userID, limit=24, after=None, cur=None):
+    return get_recipes_page(userIDs=[userID], limit=limit, after=after, cur=cur)
 
-# wrapper for user posts
-def get_user_posts(userID, cur=None):
-    return get_recipes(userIDs=[userID], random=False, limit=99, cur=cur)
 
 
+## Home feed ##
+
+
+# Rows on the home page, each one get_recipes shape: name -> (filters, order)
+HOME_ROWS = {
+    "trending": (("isDraft",), "trending"),
+    "top_rated": (("isDraft", "minAvgRating"), "random"),
+    "recent": (("isDraft",), "recent")
+}
+HOME_ROW_SIZE = 6
+
+# The feed is the same for every visitor, so each process keeps one copy for HOME_FEED_TTL
+#   seconds, dropped early by the writes that change it (invalidate_home_feed)
+HOME_FEED_TTL = env_number("HOME_FEED_TTL", 30, float)
+HOME_CACHE = LRUCache(maxsize=1, ttl=HOME_FEED_TTL)
+HOME_FLIGHT = SingleFlight()
+_homeVersion = 0
+
+
+# Every home row plus the tags in use, in one round trip
+# Returns {"trending": [...], "top_rated": [...], "recent": [...], "tags": [...]}
+def load_home_feed(cur=None):
+    columns = []
+    params = {"isDraft": False, "minAvgRating": 3, "limit": HOME_ROW_SIZE, "offset": 0}
+    for name, (filters, order) in HOME_ROWS.items():
+        # Random rows each get their own pivot, so they sample different recipes
+        sql = _recipes_sql(filters, order, False).replace("%(pivot)s", f"%({name}_pivot)s")
+        params[f"{name}_pivot"] = rng.random()
+        ordered = " ORDER BY f.sortkey DESC, f.recipeid DESC" if order in ORDERINGS else ""
+        columns.append(f"(SELECT COALESCE(json_agg(f{ordered}), '[]') FROM ({sql}) f) AS {name}")
+    columns.append("""(
+        SELECT COALESCE(json_agg(t.name ORDER BY t.name), '[]') FROM tags t
+        WHERE EXISTS (SELECT 1 FROM tagMatch tm WHERE tm.tagid = t.tagid)
+    ) AS tags""")
+
+    with get_db_cursor(commit=False, cur=cur) as cur:
+        cur.execute("SELECT " + ",\n".join(columns), params)
+        row = cur.fetchone()
+
+    feed = {name: [] for name in HOME_ROWS} | {"tags": []}
+    if row == None:
+        return feed
+    for name in HOME_ROWS:
+        feed[name] = [recipe | {"image_url": f"/api/image?recipeID={recipe['recipeid']}"} for recipe in row[name]]
+    feed["tags"] = row["tags"]
+    return feed
+
+
+# Cached home feed, concurrent misses share one load
+def get_home_feed():
+    feed = HOME_CACHE.get("home")
+    if feed is not None:
+        return feed
+
+    def load():
+        version = _homeVersion
+        feed = load_home_feed()
+        # Skip caching a load that raced a write, it may predate it
+        if version == _homeVersion:
+            HOME_CACHE.set("home", feed)
+        return feed
+    return HOME_FLIGHT.do("home", load)
+
+
+# Called after a committed write to recipes / interactions (this process only,
+#   other workers catch up within HOME_FEED_TTL)
+def invalidate_home_feed():
+    global _homeVersion
+    _homeVersion += 1
+    HOME_CACHE.clear()
+
+
+
+# Recompute stored nutrition totals (and missing kcal) for every recipe
+# Streams recipes with a server side cursor, each batch is one numpy pass and one UPDATE
+# Recipes with an ingredient missing its gram amount keep their stored totals
+def recompute_nutrition(batchSize=1000):
+    updated = 0
+    with get_db_connection() as connection:
+        read = connection.cursor(name="recompute_nutrition")
+        read.itersize = batchSize
+        read.execute("SELECT recipeid, servings, nutrients FROM recipes WHERE nutrients IS NOT NULL")
+
+        write = connection.cursor()
+        while True:
+            rows = read.fetchmany(batchSize)
+            if len(rows) == 0:
+                break
+
+            stored = [nutrients.load_stored(row[2]) for row in rows]
+            keep = [i for i, s in enumerate(stored) if nutrients.has_amounts(s)]
+            rows, stored = [rows[i] for i in keep], [stored[i] for i in keep]
+            totals = nutrients.bulk_totals([(s, row[1]) for s, row in zip(stored, rows)])
+
+            values = []
+            for row, s, total in zip(rows, stored, totals):
+                if not isinstance(s, list) or len(s) == 0:
+                    continue
+                s[0] = {"total": nutrients.to_list(total)}
+                values.append((row[0], Json(s), int(round(float(total[0])))))
+
+            if len(values) == 0:
+                continue
+            execute_values(write, """
+                UPDATE recipes r SET
+                    nutrients = v.nutrients::jsonb,
+                    kcal = COALESCE(r.kcal, v.kcal)
+                FROM (VALUES %s) AS v(recipeid, nutrients, kcal)
+                WHERE r.recipeid = v.recipeid
+            """, values)
+            updated += len(values)
+
+        read.close()
+        write.close()
+        connection.commit()
+    return updated
+
+
+# Rebuild RecipeStats from Interactions / Comments (the triggers keep it current after this)
+# Repair for drift, or to fill the table on a database that predates it
+# Scans every interaction and comment, so it lifts the pool's statement_timeout for its transaction
+def rebuild_recipe_stats(cur=None):
+    with get_db_cursor(commit=True, cur=cur) as cur:
+        cur.execute("SET LOCAL statement_timeout = 0")
+        cur.execute("LOCK TABLE interactions, comments IN SHARE MODE")
+        cur.execute("DELETE FROM recipeStats")
+        cur.execute("""
+            INSERT INTO recipeStats (recipeid, rating_sum, rating_count, save_count, comment_count)
+            SELECT r.recipeid, COALESCE(i.rating_sum, 0), COALESCE(i.rating_count, 0),
+                COALESCE(i.save_count, 0), COALESCE(c.comment_count, 0)
+            FROM recipes r
+            LEFT JOIN (
+                SELECT recipeid, SUM(rating) AS rating_sum, COUNT(rating) AS rating_count,
+                    SUM(COALESCE(saved, FALSE)::int) AS save_count
+                FROM interactions GROUP BY recipeid
+            ) i ON i.recipeid = r.recipeid
+            LEFT JOIN (
+                SELECT recipeid, COUNT(*) AS comment_count FROM comments GROUP BY recipeid
+            ) c ON c.recipeid = r.recipeid
+            WHERE i.recipeid IS NOT NULL OR c.recipeid IS NOT NULL
+        """)
+        return cur.rowcount
+
+
+# Trending score: every rating, save and comment adds its weight * 2^((time - epoch) / half life)
+#   Measured from a fixed epoch instead of now, a score never has to be decayed again,
+#   a newer event simply counts for more, so only recipes with new activity need an update
+# Stored as log2 of that sum (it would overflow a double within a few years of half lives)
+TRENDING_EPOCH = "2025-01-01"
+TRENDING_HALF_LIFE = env_number("TRENDING_HALF_LIFE_HOURS", 48, float) * 3600   # seconds
+TRENDING_WEIGHTS = {"rating": 1.0, "save": 3.0, "comment": 2.0}                  # rating weight is for 5 stars
+
+# Seconds to look back past the watermark, for writes that committed after a run started
+TRENDING_OVERLAP = 5 * 60
+
+# Scores for recipeIDs from all their scored events, recipes left without any go back to 0
+TRENDING_UPDATE = """
+    WITH events AS (
+        SELECT recipeid, lastedit, %(rating)s * rating / 5.0 AS weight
+        FROM interactions WHERE recipeid = ANY(%(ids)s) AND rating IS NOT NULL AND lastedit IS NOT NULL
+        UNION ALL
+        SELECT recipeid, lastedit, %(save)s
+        FROM interactions WHERE recipeid = ANY(%(ids)s) AND saved AND lastedit IS NOT NULL
+        UNION ALL
+        SELECT recipeid, lastedit, %(comment)s
+        FROM comments WHERE recipeid = ANY(%(ids)s) AND lastedit IS NOT NULL
+    ),
+    units AS (
+        SELECT recipeid, weight, EXTRACT(EPOCH FROM lastedit - %(epoch)s::timestamp)::float8 / %(halfLife)s AS x
+        FROM events
+    ),
+    -- log2(sum(weight * 2^x)), shifted by each recipe's newest event to stay in range
+    --   events 60+ half lives older than it add nothing measurable, and power() would
+    --   raise an underflow error for ones ~1000 half lives older
+    scores AS (
+        SELECT recipeid, top + ln(SUM(weight * power(2, x - top)) FILTER (WHERE x - top > -60)) / ln(2) AS score
+        FROM (SELECT *, MAX(x) OVER (PARTITION BY recipeid) AS top FROM units) u
+        GROUP BY recipeid, top
+    )
+    UPDATE recipes r SET trending_score = COALESCE(s.score, 0)
+    FROM unnest(%(ids)s::int[]) AS ids(recipeid)
+    LEFT JOIN scores s ON s.recipeid = ids.recipeid
+    WHERE r.recipeid = ids.recipeid AND r.trending_score IS DISTINCT FROM COALESCE(s.score, 0)
+"""
+
+
+# Rescore recipeIDs from their events (any number, in batches)
+def rescore_trending(recipeIDs, batchSize=1000, cur=None):
+    params = TRENDING_WEIGHTS | {"epoch": TRENDING_EPOCH, "halfLife": TRENDING_HALF_LIFE}
+    with get_db_cursor(commit=True, cur=cur) as cur:
+        for i in range(0, len(recipeIDs), batchSize):
+            cur.execute(TRENDING_UPDATE, params | {"ids": recipeIDs[i:i + batchSize]})
+
+
+# Update trending scores for recipes with ratings / saves / comments since the last run
+#   (full=True rescores everything, e.g. after changing the weights or half life)
+# Deletes leave nothing newer than the watermark, so delete_comment rescores its recipe itself
+#   (delete_recipe needs nothing, the score goes with the row)
+# Progress is kept in JobState, its row lock keeps two runs from overlapping
+# minInterval skips the run if another process finished one less than that many seconds ago
+# Returns the number of recipes rescored, None if skipped
+def refresh_trending(full=False, minInterval=None, batchSize=1000):
+    with get_db_cursor(commit=True) as cur:
+        cur.execute("INSERT INTO jobState (name) VALUES ('trending') ON CONFLICT (name) DO NOTHING")
+        cur.execute("SELECT watermark, lastRun, LOCALTIMESTAMP FROM jobState WHERE name = 'trending' FOR UPDATE SKIP LOCKED")
+        row = cur.fetchone()
+        if row == None:
+            return None     # another run holds the lock
+        watermark, lastRun, started = row
+        if minInterval and not full and lastRun != None and (started - lastRun).total_seconds() < minInterval:
+            return None
+
+        if full or watermark == None:
+            # Touches every recipe, not bound by the pool's per-statement limit
+            cur.execute("SET LOCAL statement_timeout = 0")
+            cur.execute("UPDATE recipes SET trending_score = 0 WHERE trending_score <> 0")
+            cur.execute("""
+                SELECT recipeid FROM interactions WHERE lastedit IS NOT NULL
+                UNION SELECT recipeid FROM comments
+            """)
+        else:
+            since = watermark - timedelta(seconds=TRENDING_OVERLAP)
+            cur.execute("""
+                SELECT recipeid FROM interactions WHERE lastedit > %s
+                UNION SELECT recipeid FROM comments WHERE lastedit > %s
+            """, (since, since))
+        recipeIDs = [row[0] for row in cur.fetchall()]
+        rescore_trending(recipeIDs, batchSize=batchSize, cur=cur)
+
+        cur.execute("UPDATE jobState SET watermark = %s, lastRun = NOW() WHERE name = 'trending'", (started,))
+        return len(recipeIDs)
+
+
+# Run refresh_trending about every `every` seconds on a background thread
+# Every web process starts one, the JobState lock and minInterval keep it to one run per interval
+def start_trending_refresh(every):
+    def loop():
+        while True:
+            time.sleep(every * (0.5 + rng.random()))    # jitter, so workers do not all wake together
+            try:
+                count = refresh_trending(minInterval=every)
+                if count != None:
+                    print(f"Trending refresh rescored {count} recipes")
+            except Exception as e:
+                print(f"Trending refresh failed - {e}")
+
+    thread = threading.Thread(target=loop, name="trending-refresh", daemon=True)
+    thread.start()
+    return thread
+
 
 # Delete a recipe with recipeID
 def delete_recipe(recipeID, userID=None, is_admin=False, cur=None):
@@ -363,7 +990,9 @@ def delete_recipe(recipeID, userID=None, is_admin=False, cur=None):
         cur.execute("DELETE FROM images WHERE recipeID = %s", (recipeID,))
 
         cur.execute("DELETE FROM recipes WHERE recipeID = %s", (recipeID,))
-        return True
+
+    invalidate_home_feed()
+    return True
 
     
 
@@ -409,10 +1038,13 @@ def _submit_interact(recipeID, userID, rating=None, saved=None, cur=None):
         DO UPDATE SET
             {"rating = EXCLUDED.rating" if doRating else ""}
             {", " if doRating and doSave else ""}
-            {"saved = EXCLUDED.saved" if doSave else ""}
+            {"saved = EXCLUDED.saved" if doSave else ""},
+            lastEdit = NOW()
         """
         cur.execute(query, tuple(queryData))
 
+    invalidate_home_feed()
+
 
 # Allow recipe saves
 # Ratings can be none, so make sure submit_interact does not overwrite rating (rating=-1)
@@ -424,37 +1056,11 @@ def submit_interact_rating(recipeID, userID, rating=None, cur=None):
     return _submit_interact(recipeID, userID, rating=rating, cur=cur)
 
 
-# Get user interactions
+# Get user interactions, newest recipes first, returns (recipes, next cursor)
 # rating is an array of ratings (filter which ratings to see)
 # saved is a boolean filter
-def get_user_interactions(userID, rating=[], saved=None, cur=None):
-    with get_db_cursor(commit=False, cur=cur) as cur:
-    
-        queryData = [userID]
-
-        doSave = False
-        if saved != None:
-            doSave = True
-            queryData.append(saved)
-        
-        doRating = False
-        if len(rating) > 0:
-            doRating = True
-            queryData.append(rating)
-
-        query = f"""
-        SELECT recipeid FROM interactions
-        WHERE userid = %s
-        {"AND saved = %s " if doSave else ""}
-        {"AND rating = ANY(%s)" if doRating else ""}
-        """
-        cur.execute(query, tuple(queryData))
-
-        res = cur.fetchall()
-        recipeIDs = [row[0] for row in res]
-        if len(recipeIDs) > 0:
-            return get_recipes(recipeIDs=recipeIDs, random=False, limit=len(recipeIDs), cur=cur)
-        return None
+def get_user_interactions(userID, rating=[], saved=None, limit=24, after=None, cur=None):
+    return get_recipes_page(interactedBy=userID, ratings=rating, saved=saved, limit=limit, after=after, cur=cur)
 
 
 ### User Profile ###
@@ -739,7 +1345,12 @@ def delete_comment(commentID, userID, cur=None):
             "DELETE FROM comments WHERE commentid = %s AND userid = %s RETURNING recipeid",
             (commentID, userID),
         )
-        return cur.fetchone() is not None
+        row = cur.fetchone()
+        if row == None:
+            return False
+        # The comment no longer counts toward trending, nothing newer than the watermark says so
+        rescore_trending([row[0]], cur=cur)
+        return True
 
 
 def is_recipe_saved(recipeID, userID, cur=None):
@@ -754,7 +1365,7 @@ def is_recipe_saved(recipeID, userID, cur=None):
         return bool(row[0]) if row and row[0] is not None else False
 
 # for browsing so that we only show tags where theres a recipe associated with it 
-def get_tag_name():
-    with get_db_cursor(commit=False) as cur:
+def get_tag_name(cur=None):
+    with get_db_cursor(commit=False, cur=cur) as cur:
         cur.execute("SELECT DISTINCT t.name FROM tags t JOIN tagmatch tm ON t.tagid = tm.tagid;")
         return ["".join(name) for name in cur.fetchall()]
\ No newline at end of file
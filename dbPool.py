@@ -0,0 +1,305 @@
+## Postgres connection pools used by db.py (drop in for psycopg2's ThreadedConnectionPool)
+##   - minconn connections are opened by prewarm() at boot, more on demand up to maxconn
+##   - getconn waits up to timeout seconds for a free connection, then raises PoolTimeout
+##   - connections idle longer than checkAfter seconds are pinged before reuse,
+##     broken ones and ones older than maxAge are closed and replaced
+##   - every connection runs with statement_timeout (ms, 0 = off)
+## ReplicaSet spreads reads over replica pools and skips ones that lag too far behind
+
+from collections import deque
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError
+
+
+# Raised by getconn when no connection frees up in time
+class PoolTimeout(PoolError):
+    pass
+
+
+# Connection that remembers its age and last use for recycling, and the names of the
+#   statements PREPAREd on it (they live as long as the session does)
+class PooledConnection(psycopg2.extensions.connection):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created = time.monotonic()
+        self.lastUsed = self.created
+        self.prepared = set()
+
+
+# Cumulative counts of values at or under each bucket bound (ms)
+class Histogram:
+
+    BOUNDS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.BOUNDS) and value > self.BOUNDS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += 1
+        self.sum += value
+
+    def stats(self):
+        buckets, running = {}, 0
+        for bound, count in zip(self.BOUNDS + ["inf"], self.counts):
+            running += count
+            buckets[f"le_{bound}"] = running
+        return {"count": self.total, "sum": round(self.sum, 2), "buckets": buckets}
+
+
+class ConnectionPool:
+
+    def __init__(self, minconn, maxconn, timeout=5, maxAge=30 * 60, checkAfter=30,
+                 statementTimeout=0, connection_factory=PooledConnection, **connectKwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.maxAge = maxAge
+        self.checkAfter = checkAfter
+        self.connection_factory = connection_factory
+        self.connectKwargs = connectKwargs
+        if statementTimeout:
+            options = connectKwargs.get("options", "")
+            self.connectKwargs["options"] = f"{options} -c statement_timeout={int(statementTimeout)}".strip()
+
+        self._idle = deque()
+        self._cond = threading.Condition()
+        self.size = 0
+        self.inUse = 0
+        self.waiters = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.recycled = 0
+        self.waitMs = Histogram()
+
+    def _connect(self):
+        return psycopg2.connect(connection_factory=self.connection_factory, **self.connectKwargs)
+
+    def _expired(self, connection):
+        created = getattr(connection, "created", None)
+        return created != None and time.monotonic() - created > self.maxAge
+
+    # Cheap check before handing out a connection that sat idle for a while
+    def _healthy(self, connection):
+        if connection.closed or self._expired(connection):
+            return False
+        if time.monotonic() - getattr(connection, "lastUsed", 0) <= self.checkAfter:
+            return True
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, connection):
+        with self._cond:
+            self.recycled += 1
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    # Open minconn connections up front, so early requests skip the connect / TLS handshake
+    def prewarm(self):
+        opened = []
+        with self._cond:
+            count = max(self.minconn - self.size, 0)
+            self.size += count
+        try:
+            for _ in range(count):
+                opened.append(self._connect())
+        finally:
+            with self._cond:
+                self.size -= count - len(opened)
+                self._idle.extend(opened)
+                self._cond.notify_all()
+        return len(opened)
+
+    def getconn(self, timeout=None):
+        timeout = self.timeout if timeout == None else timeout
+        start = time.monotonic()
+        connection = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    connection = self._idle.pop()   # most recently used, least likely stale
+                    break
+                if self.size < self.maxconn:
+                    self.size += 1                  # reserve a slot, connect outside the lock
+                    break
+                remaining = start + timeout - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout(f"no database connection free after {timeout}s ({self.maxconn} in use)")
+                self.waiters += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self.waiters -= 1
+
+        try:
+            if connection != None and not self._healthy(connection):
+                self._discard(connection)
+                connection = None
+            if connection == None:
+                connection = self._connect()
+        except Exception:
+            with self._cond:
+                self.size -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self.inUse += 1
+            self.acquired += 1
+            self.waitMs.observe((time.monotonic() - start) * 1000)
+        return connection
+
+    # Return a connection, rolled back like psycopg2's pool does
+    # close=True (or a broken / too old connection) closes it instead of keeping it
+    def putconn(self, connection, close=False):
+        if not connection.closed:
+            status = connection.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    close = True
+        close = close or connection.closed or self._expired(connection)
+
+        if close:
+            self._discard(connection)
+        else:
+            connection.lastUsed = time.monotonic()
+        with self._cond:
+            self.inUse -= 1
+            if close:
+                self.size -= 1
+            else:
+                self._idle.append(connection)
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            while self._idle:
+                self._idle.pop().close()
+                self.size -= 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                "min": self.minconn,
+                "max": self.maxconn,
+                "open": self.size,
+                "in_use": self.inUse,
+                "idle": len(self._idle),
+                "waiters": self.waiters,
+                "acquired": self.acquired,
+                "timeouts": self.timeouts,
+                "recycled": self.recycled,
+                "wait_ms": self.waitMs.stats()
+            }
+
+
+# Read replicas, each behind its own ConnectionPool
+# Replication lag is sampled at most every checkEvery seconds per replica, replicas more than
+#   maxLag seconds behind (or unreachable) are skipped until a later check says otherwise
+class ReplicaSet:
+
+    # Seconds behind the primary, 0 when everything received has been replayed
+    #   (an idle primary leaves the last replay timestamp old without any real lag)
+    LAG_QUERY = """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END
+    """
+
+    def __init__(self, pools, maxLag=5, checkEvery=5):
+        self.pools = pools
+        self.maxLag = maxLag
+        self.checkEvery = checkEvery
+        self.failovers = 0
+        self._lags = [(0.0, float("-inf"))] * len(pools)   # (lag, checked at)
+        self._checking = [False] * len(pools)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _measure(self, pool):
+        try:
+            connection = pool.getconn(timeout=1)
+        except (PoolError, psycopg2.Error):
+            return float("inf")
+        try:
+            with connection.cursor() as cur:
+                cur.execute(self.LAG_QUERY)
+                lag = float(cur.fetchone()[0])
+            connection.rollback()
+            pool.putconn(connection)
+            return lag
+        except psycopg2.Error:
+            pool.putconn(connection, close=True)
+            return float("inf")
+
+    # Cached lag, one thread refreshes it when stale while the rest use the old value
+    def lag(self, i):
+        with self._lock:
+            lag, checked = self._lags[i]
+            refresh = time.monotonic() - checked >= self.checkEvery and not self._checking[i]
+            if refresh:
+                self._checking[i] = True
+        if refresh:
+            try:
+                lag = self._measure(self.pools[i])
+            finally:
+                with self._lock:
+                    self._lags[i] = (lag, time.monotonic())
+                    self._checking[i] = False
+        return lag
+
+    # Next usable replica pool (round robin), None means read from the primary
+    def choose(self):
+        for _ in range(len(self.pools)):
+            with self._lock:
+                i = self._next
+                self._next = (i + 1) % len(self.pools)
+            if self.lag(i) <= self.maxLag:
+                return self.pools[i]
+        with self._lock:
+            self.failovers += 1
+        return None
+
+    # Skip a replica that failed a checkout until its next lag check
+    def mark_down(self, pool):
+        with self._lock:
+            self._lags[self.pools.index(pool)] = (float("inf"), time.monotonic())
+
+    def closeall(self):
+        for pool in self.pools:
+            pool.closeall()
+
+    def stats(self):
+        with self._lock:
+            lags = [lag for lag, _ in self._lags]
+        return {
+            "max_lag": self.maxLag,
+            "failovers": self.failovers,
+            "replicas": [
+                {"lag": lag if lag != float("inf") else None} | pool.stats()
+                for lag, pool in zip(lags, self.pools)
+            ]
+        }
@@ -0,0 +1,210 @@
+## Bulk recipe ingest
+## python ingest.py <file> --user-id <id> [--workers 8] [--chunk 500]
+##
+## <file> has one recipe per line, either a url to scrape or a json recipe
+##   (same keys scrape_link returns, plus optional "tags")
+## Lines are scraped in a process pool, nutrition is estimated a chunk at a time through
+## the cached USDA lookups, and each chunk is written with bulk inserts in one transaction.
+## Progress is checkpointed to <file>.checkpoint after every chunk, rerun to resume.
+## A chunk whose nutrition lookups keep failing stops the run before its checkpoint.
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+
+import db
+import nutrients
+from recipeUtil import scrape_link, canonical_url, get_batch_nutrition, NUTRITION_POOL
+
+# Column sizes from migrations/0001_initial.sql
+LIMITS = {"title": 127, "brief": 255, "link": 255}
+
+# Nutrition lookups that fail (USDA down / rate limited, queue full, deadline) are retried
+#   this many times, with backoff, before the chunk is abandoned
+LOOKUP_RETRIES = 3
+LOOKUP_FAILED = object()
+
+
+# A chunk's nutrition could not be looked up, nothing from it is written or checkpointed
+class LookupFailed(Exception):
+    pass
+
+
+# Whole number from scraped text like "4 servings" or "350 kcal", None if there is none
+def _int(value):
+    try:
+        return int(float(f"{value}".split(" ")[0]))
+    except (TypeError, ValueError):
+        return None
+
+
+# Line -> recipe dict (or None), runs in the pool
+# Scraped recipes carry the url they came from as "source"
+def load_line(line):
+    line = line.strip()
+    if not line:
+        return None
+    if line.startswith("{"):
+        try:
+            return json.loads(line)
+        except ValueError:
+            return None
+    recipe = scrape_link(line)
+    return dict(recipe, source=line) if recipe else None
+
+
+# Shape a scraped / json recipe like the edit form would submit it
+def prepare(recipe, userID):
+    out = {
+        "userID": userID,
+        "draft": False,
+        "title": recipe.get("title"),
+        "brief": recipe.get("brief"),
+        # The input url first, it is what the skip existing check looks up on a rerun
+        "link": canonical_url(recipe.get("source") or recipe.get("link")),
+        "servings": _int(recipe.get("servings")),
+        "cooktime": _int(recipe.get("cooktime")),
+        "kcal": _int(recipe.get("kcal")),
+        "steps": recipe.get("steps") or [],
+        "ingredients": recipe.get("ingredients") or [],
+        "tags": recipe.get("tags") or [],
+        "image_url": recipe.get("image_url")
+    }
+    for key, limit in LIMITS.items():
+        if out[key] and len(out[key]) > limit:
+            out[key] = out[key][:limit] if key != "link" else None
+    return out
+
+
+# Drop recipes whose link already appeared earlier in the chunk
+def dedupe(recipes):
+    seen = set()
+    out = []
+    for recipe in recipes:
+        if recipe["link"]:
+            if recipe["link"] in seen:
+                continue
+            seen.add(recipe["link"])
+        out.append(recipe)
+    return out
+
+
+# Look up sentences through the shared pool, retrying failed lookups
+# Raises LookupFailed if some still fail, so a bad USDA spell never stores zeros as "No match"
+def lookup_nutrition(sentences):
+    results = [None] * len(sentences)
+    todo = list(range(len(sentences)))
+    for attempt in range(LOOKUP_RETRIES + 1):
+        if attempt > 0:
+            print(f"Retrying {len(todo)} failed nutrition lookups")
+            time.sleep(2 ** attempt)
+
+        # Feed the shared pool no more than its queue holds, extra lines would be rejected
+        step = max(1, NUTRITION_POOL.queue_size)
+        for i in range(0, len(todo), step):
+            batch = todo[i:i + step]
+            found = get_batch_nutrition([sentences[j] for j in batch], failed=LOOKUP_FAILED)
+            for j, res in zip(batch, found):
+                results[j] = res
+
+        todo = [i for i in todo if results[i] is LOOKUP_FAILED]
+        if len(todo) == 0:
+            return results
+    raise LookupFailed(f"{len(todo)} nutrition lookups still failing after {LOOKUP_RETRIES} retries")
+
+
+# Estimate nutrition for a whole chunk with one batch of (cached) lookups
+# Stores the first USDA match per line, in the format the edit form saves
+def add_nutrition(recipes):
+    sentences = [ing for recipe in recipes for ing in recipe["ingredients"]]
+    matches = iter(lookup_nutrition(sentences))
+
+    for recipe in recipes:
+        stored = [{"total": []}]
+        for _ in recipe["ingredients"]:
+            options = next(matches)
+            if options:
+                best = options[0]
+                stored.append({"name": best["name"], "amount": best["amount"], "nutrients": ",".join(map(str, best["nutrition"]))})
+            else:
+                stored.append({"name": "No match", "amount": 0, "nutrients": ",".join(["0"] * nutrients.WIDTH)})
+
+        totals = nutrients.recipe_totals(stored, recipe["servings"])
+        stored[0] = {"total": totals["per_serving"]}
+        recipe["nutrients"] = stored
+        if recipe["kcal"] == None:
+            recipe["kcal"] = int(round(totals["kcal"]))
+
+
+def read_checkpoint(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+    return 0
+
+
+def write_checkpoint(path, done):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(f"{done}")
+    os.replace(tmp, path)
+
+
+def ingest(path, userID, workers=os.cpu_count(), chunk=500, skipExisting=True):
+    checkpoint = path + ".checkpoint"
+    done = read_checkpoint(checkpoint)
+
+    with open(path) as f:
+        lines = f.readlines()[done:]
+    if done:
+        print(f"Resuming after line {done}")
+
+    start = time.time()
+    inserted, skipped = 0, 0
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        for offset in range(0, len(lines), chunk):
+            batch = lines[offset:offset + chunk]
+
+            # Skip urls we already have before paying for a scrape
+            if skipExisting:
+                links = {canonical_url(line.strip()): line for line in batch if line.strip() and not line.startswith("{")}
+                existing = db.get_existing_links(list(links))
+                batch = ["" if canonical_url(line.strip()) in existing else line for line in batch]
+
+            loaded = list(pool.map(load_line, batch, chunksize=max(1, len(batch) // (workers * 4))))
+            recipes = dedupe([prepare(recipe, userID) for recipe in loaded if recipe and recipe.get("title")])
+            skipped += len(batch) - len(recipes)
+
+            add_nutrition(recipes)
+            inserted += len(db.bulk_insert_recipes(recipes))
+
+            done += len(lines[offset:offset + chunk])
+            write_checkpoint(checkpoint, done)
+
+            elapsed = time.time() - start
+            print(f"{done} lines, {inserted} inserted, {skipped} skipped - {inserted / elapsed:.1f} recipes/s")
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+    print(f"Done in {time.time() - start:.1f}s")
+    return inserted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk load recipes from urls or json lines")
+    parser.add_argument("file")
+    parser.add_argument("--user-id", type=int, required=True, help="owner of the imported recipes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk", type=int, default=500, help="recipes per transaction")
+    parser.add_argument("--keep-existing", action="store_true", help="import links already in the database again")
+    args = parser.parse_args()
+
+    load_dotenv(".env")
+    db.setup()
+    ingest(args.file, args.user_id, workers=args.workers, chunk=args.chunk, skipExisting=not args.keep_existing)
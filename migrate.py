@@ -0,0 +1,169 @@
+## Schema migrations and query plan checks
+## python migrate.py            apply pending migrations (also: flask --app app migrate)
+## python migrate.py check      EXPLAIN the canonical db.py queries, fail on sequential scans
+##
+## migrations/NNNN_name.sql run in name order, each once, in its own transaction.
+## Applied files are recorded in schema_migrations and a postgres advisory lock keeps
+##   concurrent deploys / gunicorn workers from applying the same file twice.
+## Files are written to be safe to run again (IF NOT EXISTS, CREATE OR REPLACE, ON CONFLICT).
+
+import os
+import sys
+
+from dotenv import load_dotenv
+
+import db
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Arbitrary key for pg_advisory_lock, shared by every process running migrations
+LOCK_KEY = 5117_0019
+
+# Tables small enough that a sequential scan is the right plan
+SEQ_SCAN_OK = {"tags"}
+
+
+def migration_files(path=MIGRATIONS_DIR):
+    return sorted(name for name in os.listdir(path) if name.endswith(".sql"))
+
+
+# Apply every migration not yet recorded, returns the names applied
+def migrate(path=MIGRATIONS_DIR):
+    applied = []
+    with db.get_db_connection() as connection:
+        cur = connection.cursor()
+        # Migrations (and waiting on another process's lock) can outlast the pool's
+        #   statement_timeout, lift it for this session and restore it below
+        cur.execute("SET statement_timeout = 0")
+        cur.execute("SELECT pg_advisory_lock(%s)", (LOCK_KEY,))
+        connection.commit()
+        try:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version VARCHAR(255) PRIMARY KEY,
+                    appliedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            connection.commit()
+
+            cur.execute("SELECT version FROM schema_migrations")
+            done = set(row[0] for row in cur.fetchall())
+
+            for name in migration_files(path):
+                if name in done:
+                    continue
+                print(f"Applying migration {name}")
+                with open(os.path.join(path, name)) as f:
+                    sql = f.read()
+                try:
+                    cur.execute(sql)
+                    cur.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (name,))
+                    connection.commit()
+                except Exception:
+                    connection.rollback()
+                    raise
+                applied.append(name)
+        finally:
+            connection.rollback()
+            cur.execute("SELECT pg_advisory_unlock(%s)", (LOCK_KEY,))
+            cur.execute("RESET statement_timeout")
+            connection.commit()
+            cur.close()
+    return applied
+
+
+## Plan checks ##
+
+
+# Stands in for a db.py cursor: EXPLAINs each statement instead of running it
+# Reads come back empty so the db.py helpers return early without touching the plan rows
+class ExplainCursor:
+
+    def __init__(self, cur):
+        self.cur = cur
+        self.plans = []
+        self.rowcount = 0
+
+    def execute(self, query, args=None):
+        self.cur.execute("EXPLAIN (FORMAT JSON) " + query, args)
+        self.plans.append((query, self.cur.fetchone()[0][0]["Plan"]))
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+
+# Every (node type, relation) in a plan tree
+def _scans(plan):
+    yield plan.get("Node Type"), plan.get("Relation Name")
+    for child in plan.get("Plans", []):
+        yield from _scans(child)
+
+
+# The read queries db.py runs on every page, each called through its real helper
+CANONICAL_QUERIES = {
+    "get_recipe": lambda cur: db.get_recipe(1, cur=cur),
+    "home feed": lambda cur: db.load_home_feed(cur=cur),
+    "search text": lambda cur: db.get_recipes_page(search="chicken soup", order="rank", limit=20, cur=cur),
+    "search tags": lambda cur: db.get_recipes_page(tags=[1, 2], limit=20, cur=cur),
+    "get_recipe_by_link": lambda cur: db.get_recipe_by_link(["https://example.com/recipe"], cur=cur),
+    "get_existing_links": lambda cur: db.get_existing_links(["https://example.com/recipe"], cur=cur),
+    "get_user_posts": lambda cur: db.get_user_posts(1, cur=cur),
+    "get_user_drafts": lambda cur: db.get_user_drafts(1, cur=cur),
+    "get_user_interactions": lambda cur: db.get_user_interactions(1, saved=True, cur=cur),
+    "get_user_by_oauth": lambda cur: db.get_user_by_oauth("oauth|1", "auth0", cur=cur),
+    "get_user_rating": lambda cur: db.get_user_rating(1, 1, cur=cur),
+    "is_recipe_saved": lambda cur: db.is_recipe_saved(1, 1, cur=cur),
+    "get_comments": lambda cur: db.get_comments(1, cur=cur),
+    "get_image recipe": lambda cur: db.get_image(recipeID=1, cur=cur),
+    "get_image profile": lambda cur: db.get_image(userID=1, cur=cur),
+    "get_tag_name": lambda cur: db.get_tag_name(cur=cur),
+}
+
+
+# EXPLAIN each canonical query with sequential scans disabled, so any Seq Scan left
+#   in a plan means no index can serve it
+# Seeds a few rows first and rolls everything back, safe to point at a live database
+# Returns a list of (query name, table) failures
+def check_plans():
+    failures = []
+    with db.get_db_connection() as connection:
+        cur = connection.cursor()
+        try:
+            cur.execute("""
+                INSERT INTO users (oauthid, oauthprovider, username) VALUES ('plan-check', 'plan-check', 'plan-check')
+                RETURNING userid
+            """)
+            userID = cur.fetchone()[0]
+            cur.execute("""
+                INSERT INTO recipes (userid, draft, title, brief, link, steps, ingredients)
+                SELECT %s, i %% 5 = 0, 'Chicken soup ' || i, 'Plan check', 'https://example.com/' || i, '[]', '["1 cup broth"]'
+                FROM generate_series(1, 200) i
+            """, (userID,))
+            cur.execute("ANALYZE recipes")
+            cur.execute("SET LOCAL enable_seqscan = off")
+
+            explain = ExplainCursor(cur)
+            for name, run in CANONICAL_QUERIES.items():
+                start = len(explain.plans)
+                run(explain)
+                found = [
+                    table for _, plan in explain.plans[start:] for node, table in _scans(plan)
+                    if node == "Seq Scan" and table not in SEQ_SCAN_OK
+                ]
+                failures += [(name, table) for table in found]
+                print(f"{name:24} {'seq scan on ' + ', '.join(found) if found else 'ok'}")
+        finally:
+            connection.rollback()
+            cur.close()
+    return failures
+
+
+if __name__ == "__main__":
+    load_dotenv(".env")
+    db.setup()
+    if len(sys.argv) > 1 and sys.argv[1] == "check":
+        sys.exit(1 if check_plans() else 0)
+    print(f"Applied {len(migrate())} migrations")
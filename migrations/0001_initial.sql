@@ -1,4 +1,6 @@
-
+-- Base schema
+-- Applied by migrate.py like every file in this folder: in name order, once each,
+--   and written to be safe to run again (IF NOT EXISTS / ON CONFLICT)
 
 -- GOAL (recipes, users, recipe tags, comments, users, pictures?)
 
@@ -10,7 +12,7 @@
 
 -- USERS
 
-CREATE TABLE Users (
+CREATE TABLE IF NOT EXISTS Users (
     UserID SERIAL PRIMARY KEY,
     OauthID VARCHAR(255) NOT NULL,   -- OAUTH user.sub field
     OauthProvider VARCHAR(63) NOT NULL,
@@ -23,7 +25,7 @@ CREATE TABLE Users (
 
 -- RECIPES and TAGS
 
-CREATE TABLE Recipes (
+CREATE TABLE IF NOT EXISTS Recipes (
     RecipeID SERIAL PRIMARY KEY,
     UserID INT,
     draft BOOLEAN NOT NULL,
@@ -41,12 +43,12 @@ CREATE TABLE Recipes (
     FOREIGN KEY (UserID) REFERENCES Users(UserID) ON DELETE SET NULL  -- DELETE on CASCADE?
 );
 
-CREATE TABLE Tags (
+CREATE TABLE IF NOT EXISTS Tags (
     tagID SERIAL PRIMARY KEY,       -- SHOULD THIS BE A STRING?
     name VARCHAR(32) UNIQUE
 );
 
-CREATE TABLE TagMatch (
+CREATE TABLE IF NOT EXISTS TagMatch (
     RecipeID INT,
     TagID INT,
     PRIMARY KEY (RecipeID, TagID),
@@ -61,7 +63,7 @@ CREATE TABLE TagMatch (
 -- JOIN Tags t ON tm.TagID = t.TagID
 -- WHERE t.name = 'Breakfast'
 
--- CREATE TABLE nutrition (
+-- CREATE TABLE IF NOT EXISTS nutrition (
 --     recipeID INT,
 --     accepted JSONB,
 --     rejected JSONB,
@@ -72,7 +74,7 @@ CREATE TABLE TagMatch (
 -- INTERACTIONS
 
 -- PREVIOUSLY 'Likes' and 'Ratings'
-CREATE TABLE Interactions (
+CREATE TABLE IF NOT EXISTS Interactions (
     recipeID INT,
     userID INT,
     rating INT,
@@ -85,7 +87,7 @@ CREATE TABLE Interactions (
 
 -- COMMENTS
 
-CREATE TABLE Comments (
+CREATE TABLE IF NOT EXISTS Comments (
     CommentID SERIAL,
     RecipeID INT,
     UserID INT,
@@ -103,7 +105,7 @@ CREATE TABLE Comments (
 -- IMAGES 
 
 -- PYTHON PILLOW FOR LOWERING FILE SIZE??
-CREATE TABLE Images (
+CREATE TABLE IF NOT EXISTS Images (
     ImageID SERIAL PRIMARY KEY,
     UserID INT,
     RecipeID INT,
@@ -116,8 +118,7 @@ CREATE TABLE Images (
 
 
 -- INSERT DATA (tags)
--- Record tagID and put into dp.py
-TRUNCATE TABLE TAGS RESTART IDENTITY CASCADE;
+-- Record tagID and put into dp.py (ids follow this order on a fresh database)
 INSERT INTO tags (name)
 VALUES
   ('air-fryer'),
@@ -165,4 +166,4 @@ VALUES
   ('vegan'),
   ('vegetarian'),
   ('winter')
-RETURNING TAGID, NAME;
\ No newline at end of file
+ON CONFLICT (name) DO NOTHING;
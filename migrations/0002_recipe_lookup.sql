@@ -0,0 +1,32 @@
+-- Recipe lookup columns and indexes: import links, random sampling, search, keyset pages
+
+
+-- Imported recipes are looked up by source link
+CREATE INDEX IF NOT EXISTS recipes_link_idx ON Recipes (link);
+
+
+-- Random rows are an index range scan from a random pivot instead of ORDER BY RANDOM()
+--   (see db.get_recipes), existing rows each get their own random() value
+ALTER TABLE Recipes ADD COLUMN IF NOT EXISTS randkey DOUBLE PRECISION NOT NULL DEFAULT random();
+CREATE INDEX IF NOT EXISTS recipes_randkey_idx ON Recipes (randkey);
+
+
+-- Search: ranked full text over title / brief / ingredients / steps, trigram title matches for typos
+ALTER TABLE Recipes ADD COLUMN IF NOT EXISTS search_doc TSVECTOR GENERATED ALWAYS AS (
+    setweight(to_tsvector('english', COALESCE(title, '')), 'A') ||
+    setweight(to_tsvector('english', COALESCE(brief, '')), 'B') ||
+    setweight(jsonb_to_tsvector('english', COALESCE(ingredients, '[]'), '["string"]'), 'C') ||
+    setweight(jsonb_to_tsvector('english', COALESCE(steps, '[]'), '["string"]'), 'D')
+) STORED;
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS recipes_search_idx ON Recipes USING GIN (search_doc);
+CREATE INDEX IF NOT EXISTS recipes_title_trgm_idx ON Recipes USING GIN (title gin_trgm_ops);
+
+
+-- Keyset pages: newest first overall and per author
+CREATE INDEX IF NOT EXISTS recipes_lastedit_idx ON Recipes (lastEdit, recipeID);
+CREATE INDEX IF NOT EXISTS recipes_user_lastedit_idx ON Recipes (userID, lastEdit, recipeID);
+
+-- A user's saved / rated recipes
+CREATE INDEX IF NOT EXISTS interactions_user_idx ON Interactions (userID, recipeID);
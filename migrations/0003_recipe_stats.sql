@@ -0,0 +1,94 @@
+-- RECIPE STATS
+
+-- Per recipe counters, kept current by the triggers below so reads are a primary key join
+--   instead of aggregating all of Interactions / Comments every query
+-- Rebuild from scratch with: flask rebuild-stats
+
+-- Hold off writers until the triggers and backfill commit together
+LOCK TABLE Interactions, Comments IN SHARE MODE;
+CREATE TABLE IF NOT EXISTS RecipeStats (
+    recipeID INT PRIMARY KEY,
+    rating_sum BIGINT NOT NULL DEFAULT 0,
+    rating_count INT NOT NULL DEFAULT 0,
+    save_count INT NOT NULL DEFAULT 0,
+    comment_count INT NOT NULL DEFAULT 0,
+    avg_rating NUMERIC GENERATED ALWAYS AS (rating_sum::numeric / NULLIF(rating_count, 0)) STORED,
+    FOREIGN KEY (recipeID) REFERENCES Recipes(recipeID) ON DELETE CASCADE
+);
+
+-- Apply the difference between the old and new interaction row
+-- Deletes only UPDATE, a cascading recipe delete may have removed the stats row already
+CREATE OR REPLACE FUNCTION recipe_stats_interactions() RETURNS trigger AS $$
+DECLARE
+    rid INT := COALESCE(NEW.recipeID, OLD.recipeID);
+    dSum BIGINT := 0;
+    dCount INT := 0;
+    dSaves INT := 0;
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        dSum := dSum + COALESCE(NEW.rating, 0);
+        dCount := dCount + (NEW.rating IS NOT NULL)::int;
+        dSaves := dSaves + COALESCE(NEW.saved, FALSE)::int;
+    END IF;
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        dSum := dSum - COALESCE(OLD.rating, 0);
+        dCount := dCount - (OLD.rating IS NOT NULL)::int;
+        dSaves := dSaves - COALESCE(OLD.saved, FALSE)::int;
+    END IF;
+
+    IF TG_OP = 'DELETE' THEN
+        UPDATE RecipeStats SET
+            rating_sum = rating_sum + dSum,
+            rating_count = rating_count + dCount,
+            save_count = save_count + dSaves
+        WHERE recipeID = rid;
+    ELSE
+        INSERT INTO RecipeStats (recipeID, rating_sum, rating_count, save_count)
+        VALUES (rid, dSum, dCount, dSaves)
+        ON CONFLICT (recipeID) DO UPDATE SET
+            rating_sum = RecipeStats.rating_sum + EXCLUDED.rating_sum,
+            rating_count = RecipeStats.rating_count + EXCLUDED.rating_count,
+            save_count = RecipeStats.save_count + EXCLUDED.save_count;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS interactions_stats ON Interactions;
+CREATE TRIGGER interactions_stats
+AFTER INSERT OR UPDATE OR DELETE ON Interactions
+FOR EACH ROW EXECUTE FUNCTION recipe_stats_interactions();
+
+CREATE OR REPLACE FUNCTION recipe_stats_comments() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO RecipeStats (recipeID, comment_count) VALUES (NEW.recipeID, 1)
+        ON CONFLICT (recipeID) DO UPDATE SET comment_count = RecipeStats.comment_count + 1;
+    ELSE
+        UPDATE RecipeStats SET comment_count = comment_count - 1 WHERE recipeID = OLD.recipeID;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS comments_stats ON Comments;
+CREATE TRIGGER comments_stats
+AFTER INSERT OR DELETE ON Comments
+FOR EACH ROW EXECUTE FUNCTION recipe_stats_comments();
+
+
+-- Backfill counters that predate the triggers (same query as db.rebuild_recipe_stats)
+INSERT INTO RecipeStats (recipeID, rating_sum, rating_count, save_count, comment_count)
+SELECT r.recipeID, COALESCE(i.rating_sum, 0), COALESCE(i.rating_count, 0),
+    COALESCE(i.save_count, 0), COALESCE(c.comment_count, 0)
+FROM Recipes r
+LEFT JOIN (
+    SELECT recipeID, SUM(rating) AS rating_sum, COUNT(rating) AS rating_count,
+        SUM(COALESCE(saved, FALSE)::int) AS save_count
+    FROM Interactions GROUP BY recipeID
+) i ON i.recipeID = r.recipeID
+LEFT JOIN (
+    SELECT recipeID, COUNT(*) AS comment_count FROM Comments GROUP BY recipeID
+) c ON c.recipeID = r.recipeID
+WHERE i.recipeID IS NOT NULL OR c.recipeID IS NOT NULL
+ON CONFLICT (recipeID) DO NOTHING;
@@ -0,0 +1,17 @@
+-- Indexes for the remaining hot db.py filters
+-- Recipes(userID) and Interactions(userID) are the leading columns of
+--   recipes_user_lastedit_idx / interactions_user_idx from 0002
+
+
+-- get_recipes: published (draft = false) recipes, newest first
+CREATE INDEX IF NOT EXISTS recipes_draft_lastedit_idx ON Recipes (draft, lastEdit, recipeID);
+
+-- get_comments: a recipe's thread in posting order
+CREATE INDEX IF NOT EXISTS comments_recipe_lastedit_idx ON Comments (recipeID, lastEdit, commentID);
+
+-- get_image / submit_image / profile pictures
+CREATE INDEX IF NOT EXISTS images_recipe_idx ON Images (recipeID);
+CREATE INDEX IF NOT EXISTS images_user_idx ON Images (userID);
+
+-- get_recipes tag filter and get_tag_name
+CREATE INDEX IF NOT EXISTS tagmatch_tag_idx ON TagMatch (tagID, recipeID);
@@ -0,0 +1,24 @@
+-- TRENDING SCORE
+
+-- Recipes.trending_score is kept by db.refresh_trending (flask refresh-trending, run on a
+--   schedule), the home page "trending" row reads it straight off recipes_draft_trending_idx
+-- 0 means no scored activity
+
+ALTER TABLE Recipes ADD COLUMN IF NOT EXISTS trending_score DOUBLE PRECISION NOT NULL DEFAULT 0;
+CREATE INDEX IF NOT EXISTS recipes_draft_trending_idx ON Recipes (draft, trending_score, recipeID);
+
+-- When a rating / save was last changed
+-- Rows from before this migration stay NULL (unknown age) and are not scored
+ALTER TABLE Interactions ADD COLUMN IF NOT EXISTS lastEdit TIMESTAMP;
+ALTER TABLE Interactions ALTER COLUMN lastEdit SET DEFAULT CURRENT_TIMESTAMP;
+
+-- refresh_trending: what changed since its last run
+CREATE INDEX IF NOT EXISTS interactions_lastedit_idx ON Interactions (lastEdit);
+CREATE INDEX IF NOT EXISTS comments_lastedit_idx ON Comments (lastEdit);
+
+-- Progress of periodic jobs, watermark = everything changed before it has been processed
+CREATE TABLE IF NOT EXISTS JobState (
+    name VARCHAR(63) PRIMARY KEY,
+    watermark TIMESTAMP,
+    lastRun TIMESTAMP
+);
@@ -0,0 +1,110 @@
+## Nutrient vectors
+## Every food / ingredient is a float32 row: [kcal, NUTRIENT_KEYS...] per gram
+## Recipe totals are a (grams @ rows) product instead of per-item python loops
+##   Kept free of the parser / scraper imports so db.py can use it
+
+import json
+
+import numpy as np
+
+# Indicies aligned, API keys for the below nutrients
+NUTRIENT_KEYS = ['203', '204', '205', '269', '291', '301', '303', '306', '307', '320', '401', '601', '605', '606']
+NUTRIENTS = ['Protein (g)', 'Total Fat (g)', 'Carbohydrates (g)', 'Sugars (g)', 'Fiber (g)', 'Calcium (mg)', 'Iron (mg)', 'Potassium (mg)', 'Sodium (mg)', 'Vitamin A (µg)', 'Vitamin C (mg)', 'Cholesterol (mg)', 'Trans Fat (g)', 'Saturated Fat (g)']
+
+# Column 0 is kcal, nutrient key -> column
+WIDTH = len(NUTRIENT_KEYS) + 1
+NUTRIENT_INDEX = {key: i + 1 for i, key in enumerate(NUTRIENT_KEYS)}
+
+# kcal per gram of protein, fat, carbs
+KCAL_WEIGHTS = np.zeros(WIDTH, dtype=np.float32)
+KCAL_WEIGHTS[NUTRIENT_INDEX['203']] = 4
+KCAL_WEIGHTS[NUTRIENT_INDEX['204']] = 9
+KCAL_WEIGHTS[NUTRIENT_INDEX['205']] = 4
+
+
+# Per gram vector from a USDA food (USDA values are per 100 grams)
+def nutrient_vector(food):
+    vec = np.zeros(WIDTH, dtype=np.float32)
+    for item in food.get("foodNutrients", []):
+        col = NUTRIENT_INDEX.get(item.get("nutrientNumber"))
+        if col is not None:
+            vec[col] = round(item.get("value", 0) / 100, 2)
+    vec[0] = round(float(vec @ KCAL_WEIGHTS), 2)
+    return vec
+
+
+# Vector as the plain list stored / sent to the client
+def to_list(vec):
+    return [round(float(value), 2) for value in vec]
+
+
+# Stored ingredient nutrients are "a,b,c" strings (from the edit form) or lists
+def _row(value):
+    if isinstance(value, str):
+        value = value.split(",") if value.strip() else []
+    row = np.zeros(WIDTH, dtype=np.float32)
+    values = [float(v) if v not in (None, "") else 0.0 for v in value[:WIDTH]]
+    row[:len(values)] = values
+    return row
+
+
+# Stack a recipe's stored ingredient entries into (grams, matrix)
+# stored is the recipes.nutrients list: [{"total": ...}, {"name", "amount", "nutrients"}, ...]
+def recipe_matrix(stored):
+    items = [item for item in (stored or []) if isinstance(item, dict) and "nutrients" in item]
+    grams = np.array([float(item.get("amount") or 0) for item in items], dtype=np.float32)
+    matrix = np.stack([_row(item["nutrients"]) for item in items]) if items else np.zeros((0, WIDTH), dtype=np.float32)
+    return grams, matrix
+
+
+# True when every ingredient entry has a usable gram amount
+# Recipes saved before the edit form sent amounts store null there, their totals can not be
+#   recomputed from the entries (they would count those ingredients as 0 grams)
+def has_amounts(stored):
+    for item in (stored or []):
+        if not isinstance(item, dict) or "nutrients" not in item:
+            continue
+        try:
+            amount = float(item.get("amount"))
+        except (TypeError, ValueError):
+            return False
+        if not np.isfinite(amount):
+            return False
+    return True
+
+
+# Totals for one recipe, per serving values are what the nutrition label shows
+def recipe_totals(stored, servings=None):
+    grams, matrix = recipe_matrix(stored)
+    total = grams @ matrix
+    servings = servings if servings and servings > 0 else 1
+    return {
+        "total": to_list(total),
+        "per_serving": to_list(total / servings),
+        "kcal": round(float(total[0] / servings), 2)
+    }
+
+
+# Totals for many recipes in one pass
+# recipes is a list of (stored nutrients, servings), returns a (recipes x WIDTH) per serving matrix
+def bulk_totals(recipes):
+    grams, rows, owner = [], [], []
+    for i, (stored, _) in enumerate(recipes):
+        g, m = recipe_matrix(stored)
+        grams.append(g)
+        rows.append(m)
+        owner.append(np.full(len(g), i))
+
+    totals = np.zeros((len(recipes), WIDTH), dtype=np.float32)
+    if len(recipes) == 0:
+        return totals
+    grams, rows, owner = np.concatenate(grams), np.concatenate(rows), np.concatenate(owner)
+    np.add.at(totals, owner, rows * grams[:, None])
+
+    servings = np.array([s if s and s > 0 else 1 for _, s in recipes], dtype=np.float32)
+    return totals / servings[:, None]
+
+
+# Stored nutrients may come back from psycopg2 as text
+def load_stored(value):
+    return json.loads(value) if isinstance(value, str) else value
@@ -0,0 +1,125 @@
+## Optional ingredient parsing backend
+## Runs ingredient-parser model inference in a warm process pool so it stops holding
+## the GIL in request threads. Sentences from concurrent requests are gathered into
+## micro batches (up to PARSER_BATCH_MAX lines or PARSER_BATCH_WINDOW_MS) per model call.
+##
+## Enable with PARSER_BACKEND=process, recipeUtil.parse_one / parse_many pick it up
+## Returned ParsedIngredient objects are the same dataclasses parse_ingredient gives back
+##   (pint units are re-bound to pint's application registry, recipeUtil only reads their names)
+
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
+
+from cache import env_number
+
+PROCESSES = env_number("PARSER_PROCESSES", 2)
+BATCH_MAX = env_number("PARSER_BATCH_MAX", 64)
+BATCH_WINDOW = env_number("PARSER_BATCH_WINDOW_MS", 5, float) / 1000
+TIMEOUT = env_number("PARSER_TIMEOUT", 30, float)
+
+
+## Worker process side ##
+
+
+# Load the model once per worker so the first real request is not the slow one
+def _warm():
+    from ingredient_parser import parse_ingredient
+    parse_ingredient("1 cup flour")
+
+
+def _parse_batch(sentences):
+    from ingredient_parser import parse_multiple_ingredients
+    return parse_multiple_ingredients(sentences=sentences)
+
+
+def _ready():
+    return True
+
+
+# True inside a pool worker, spawn re-imports the parent's main module there
+def is_worker():
+    return multiprocessing.parent_process() is not None
+
+
+## Request side ##
+
+
+class ParserPool:
+
+    def __init__(self, processes=PROCESSES, batch_max=BATCH_MAX, window=BATCH_WINDOW):
+        self.processes = processes
+        self.batch_max = batch_max
+        self.window = window
+        self.batches = 0
+        self.sentences = 0
+        self._queue = queue.Queue()
+        # spawn, forking a threaded flask worker is asking for trouble
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_warm
+        )
+        self._collector = threading.Thread(target=self._collect, name="parser-batcher", daemon=True)
+        self._collector.start()
+
+    # Start every worker now instead of on first use
+    def prewarm(self):
+        for future in [self._pool.submit(_ready) for _ in range(self.processes)]:
+            future.result(timeout=TIMEOUT * 4)
+
+    # Gather queued sentences into a batch, ship it to the pool, fan results back out
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.batch_max:
+                    batch.append(self._queue.get(timeout=self.window))
+            except queue.Empty:
+                pass
+
+            self.batches += 1
+            self.sentences += len(batch)
+            try:
+                job = self._pool.submit(_parse_batch, [sentence for sentence, _ in batch])
+            except Exception as e:
+                for _, waiter in batch:
+                    waiter.set_exception(e)
+                continue
+            job.add_done_callback(lambda job, batch=batch: self._deliver(job, batch))
+
+    @staticmethod
+    def _deliver(job, batch):
+        try:
+            results = job.result()
+        except Exception as e:
+            for _, waiter in batch:
+                waiter.set_exception(e)
+            return
+        for (_, waiter), parsed in zip(batch, results):
+            waiter.set_result(parsed)
+
+    def _enqueue(self, sentence):
+        waiter = concurrent.futures.Future()
+        self._queue.put((sentence, waiter))
+        return waiter
+
+    def parse(self, sentence):
+        return self._enqueue(sentence).result(timeout=TIMEOUT)
+
+    # Lines are queued one by one so they can share batches with other requests
+    # One TIMEOUT covers the whole call, lines not parsed by then come back as None
+    def parse_many(self, sentences):
+        waiters = [self._enqueue(sentence) for sentence in sentences]
+        done, _ = concurrent.futures.wait(waiters, timeout=TIMEOUT)
+        return [waiter.result() if waiter in done else None for waiter in waiters]
+
+    def stats(self):
+        return {
+            "processes": self.processes,
+            "batches": self.batches,
+            "sentences": self.sentences,
+            "avg_batch": round(self.sentences / self.batches, 2) if self.batches else 0.0,
+            "queued": self._queue.qsize()
+        }
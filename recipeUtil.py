@@ -1,16 +1,26 @@
 import os
 import csv
-import requests
 import concurrent.futures
+import dataclasses
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from pint import UnitRegistry
+import requests
+
+from cache import LRUCache, TieredCache, SingleFlight, normalize_key, env_number
+import usdaIndex
+from nutrients import NUTRIENT_KEYS, NUTRIENTS, nutrient_vector, to_list
+import usdaClient
+from workQueue import BoundedExecutor, QueueFull
 
 # Auto tool for scraping recipes
 # https://docs.recipe-scrapers.com/
-from recipe_scrapers import scrape_me
+from recipe_scrapers import scrape_html
 
 # Auto tool for parsing ingredients
 # https://github.com/strangetom/ingredient-parser
 from ingredient_parser import parse_ingredient, parse_multiple_ingredients
+import parserPool
 
 ## FOUNDATION FOODS DATASET
 ## https://fdc.nal.usda.gov/api-guide
@@ -49,36 +59,213 @@ UREG.define("can = 10.5 * oz = cans")
 UREG.define("stalk = 7 * oz = stalks")
 UREG.define("stick = 8 * oz = sticks")
 
+
+# Look up a unit with pint
+# Returns ("mass", grams per unit), ("volume", ml per unit), ("other", 0) or None if unknown
+def _pint_unit(unitName):
+    if unitName not in UREG:
+        return None
+    unit = UREG(unitName)
+    if unit.check("[mass]"):
+        return ("mass", unit.to("gram").magnitude)
+    if unit.check("[volume]"):
+        return ("volume", unit.to("milliliter").magnitude)
+    return ("other", 0)
+
+
+# Units the ingredient parser hands back, resolved once at startup
+# Anything else goes through pint on first sight and is remembered in UNIT_CACHE
+#   (bounded, unit text comes straight from user input)
+COMMON_UNITS = [
+    "g", "gram", "grams", "kg", "kilogram", "kilograms", "mg", "milligram",
+    "oz", "ounce", "ounces", "lb", "lbs", "pound", "pounds",
+    "ml", "milliliter", "milliliters", "millilitre", "l", "liter", "liters", "litre", "dl", "cl",
+    "tsp", "teaspoon", "teaspoons", "tbsp", "tablespoon", "tablespoons",
+    "cup", "cups", "pint", "pints", "quart", "quarts", "gallon", "gallons",
+    "fl oz", "fluid_ounce", "fluid ounce", "fluid ounces", "pinch", "dash", "drop",
+    "can", "cans", "stalk", "stalks", "stick", "sticks"
+]
+UNIT_TABLE = {}
+for _unit in COMMON_UNITS:
+    try:
+        UNIT_TABLE[_unit] = _pint_unit(_unit)
+    except Exception:
+        pass    # not every spelling parses in every pint version
+UNIT_CACHE = LRUCache(maxsize=env_number("UNIT_CACHE_SIZE", 1024))
+
 # USDA api key
 USDA_API_KEY = os.getenv('USDA_API_KEY')
 
-# Indicies aligned, API keys for the below nutrients
-NUTRIENT_KEYS = ['203', '204', '205', '269', '291', '301', '303', '306', '307', '320', '401', '601', '605', '606']
-NUTRIENTS = ['Protein (g)', 'Total Fat (g)', 'Carbohydrates (g)', 'Sugars (g)', 'Fiber (g)', 'Calcium (mg)', 'Iron (mg)', 'Potassium (mg)', 'Sodium (mg)', 'Vitamin A (µg)', 'Vitamin C (mg)', 'Cholesterol (mg)', 'Trans Fat (g)', 'Saturated Fat (g)']
+# Where get_nutrients looks up foods
+#   "remote" - USDA search api (default)
+#   "local"  - offline index built by usdaIndex.py (falls back to remote if missing)
+USDA_SOURCE = os.getenv("USDA_SOURCE", "remote")
+
+# Where ingredient sentences get parsed
+#   "inline"  - in the calling thread (default)
+#   "process" - warm process pool with micro batching, see parserPool.py
+PARSER_BACKEND = os.getenv("PARSER_BACKEND", "inline")
+PARSER_POOL = None
+if PARSER_BACKEND == "process" and not parserPool.is_worker():
+    PARSER_POOL = parserPool.ParserPool()
+
+# Parsed sentences, "1 tsp salt" parses the same every time
+PARSE_CACHE = LRUCache(maxsize=env_number("PARSE_CACHE_SIZE", 4096))
+
     
 
+# Cache USDA responses, the same ingredients get looked up over and over
+#   USDA_CACHE_PATH sqlite file shared by workers ("" to keep it in memory only)
+#   USDA_CACHE_TTL seconds before an entry is refetched (default 30 days)
+#   USDA_CACHE_ROWS most entries kept in the sqlite file, oldest expiry evicted first
+USDA_CACHE = TieredCache(
+    path=os.getenv("USDA_CACHE_PATH", "usda_cache.sqlite3"),
+    table="usda",
+    maxsize=env_number("USDA_CACHE_SIZE", 2048),
+    maxrows=env_number("USDA_CACHE_ROWS", 20000),
+    ttl=env_number("USDA_CACHE_TTL", 30 * 24 * 60 * 60)
+)
+
+# Concurrent lookups of the same normalized query share one upstream call
+USDA_FLIGHT = SingleFlight()
+
+# One pool per process for the nutrition fan-out, caps outbound USDA threads at
+#   gunicorn workers * NUTRITION_WORKERS no matter how many requests are running
+NUTRITION_POOL = BoundedExecutor(
+    workers=env_number("NUTRITION_WORKERS", usdaClient.POOL_SIZE),
+    queue_size=env_number("NUTRITION_QUEUE", 200),
+    name="nutrition"
+)
+
+
 # Fetch USDA data by fdc_id
 def fetch_usda_data(foods=[]):
+    key = "fetch:" + ",".join(sorted(f"{food}" for food in foods))
+    cached = USDA_CACHE.get(key)
+    if cached is not None:
+        return cached
+    return USDA_FLIGHT.do(key, lambda: _fetch_usda_data(foods, key))
+
+
+# Uncached fetch, only called through fetch_usda_data
+def _fetch_usda_data(foods, key):
     url = "https://api.nal.usda.gov/fdc/v1/foods"
-    res = requests.get(url, params= {
-        "fdcIds":       ",".join(foods),
-        "nutrients":    ",".join(NUTRIENT_KEYS.keys()),
-        "api_key":      USDA_API_KEY
-    })
-    # res.raise_for_status()
-    return res.json()
+    try:
+        data = usdaClient.get(url, params= {
+            "fdcIds":       ",".join(foods),
+            "nutrients":    ",".join(NUTRIENT_KEYS),
+            "api_key":      USDA_API_KEY
+        })
+    except usdaClient.USDAError as e:
+        print(f"USDA fetch failed - {e}")
+        return []
+
+    # Only cache real results (errors come back as a dict)
+    if isinstance(data, list):
+        USDA_CACHE.set(key, data)
+    return data
 
 
 # Search USDA data by name
 def search_usda_data(food, pageSize=10):
+    key = f"search:{pageSize}:{normalize_key(food)}"
+    cached = USDA_CACHE.get(key)
+    if cached is not None:
+        return cached
+    return USDA_FLIGHT.do(key, lambda: _search_usda_data(food, pageSize, key))
+
+
+# Uncached search, only called through search_usda_data
+# Raises usdaClient.USDAError when USDA is unavailable, callers decide what a failed
+#   lookup means (the web pages show no match, ingest retries)
+def _search_usda_data(food, pageSize, key):
     url = "https://api.nal.usda.gov/fdc/v1/foods/search"
-    res = requests.get(url, params= {
+    data = usdaClient.get(url, params= {
         "query":        food,
         "api_key":      USDA_API_KEY,
         "pageSize":     pageSize
     })
-    # res.raise_for_status()
-    return res.json()
+
+    # Cache before the flight lands so late callers hit the cache
+    if "foods" in data:
+        data = {"foods": [slim_food(food) for food in data["foods"]]}
+        USDA_CACHE.set(key, data)
+    return data
+
+
+# Keep only what get_nutrients reads, a search result carries every nutrient,
+#   portions, brand info etc and would bloat both cache tiers
+def slim_food(food):
+    return {
+        "description": food.get("description", ""),
+        "foodCategory": food.get("foodCategory"),
+        "foodNutrients": [
+            {"nutrientNumber": item.get("nutrientNumber"), "value": item.get("value", 0)}
+            for item in food.get("foodNutrients", [])
+            if item.get("nutrientNumber") in NUTRIENT_KEYS
+        ]
+    }
+
+
+# Cached parses are shared, hand back a copy carrying the caller's own sentence
+def _cached_parse(sentence):
+    parsed = PARSE_CACHE.get(normalize_key(sentence))
+    if parsed == None:
+        return None
+    return dataclasses.replace(parsed, sentence=sentence)
+
+
+# Parse 1 ingredient sentence with the configured backend
+def parse_one(sentence):
+    cached = _cached_parse(sentence)
+    if cached != None:
+        return cached
+
+    parsed = None
+    if PARSER_POOL != None:
+        try:
+            parsed = PARSER_POOL.parse(sentence)
+        except Exception as e:
+            print(f"Parser pool failed, parsing inline - {e}")
+    if parsed == None:
+        parsed = parse_ingredient(sentence)
+
+    PARSE_CACHE.set(normalize_key(sentence), parsed)
+    return parsed
+
+
+# Parse a list of ingredient sentences with the configured backend
+# Only sentences missing from PARSE_CACHE go to the model
+# Lines the parser pool did not finish in time come back as None
+def parse_many(sentences):
+    results = [_cached_parse(sentence) for sentence in sentences]
+    misses = [i for i, parsed in enumerate(results) if parsed == None]
+    if len(misses) == 0:
+        return results
+
+    toParse = [sentences[i] for i in misses]
+    parsed = None
+    if PARSER_POOL != None:
+        try:
+            parsed = PARSER_POOL.parse_many(toParse)
+        except Exception as e:
+            print(f"Parser pool failed, parsing inline - {e}")
+    if parsed == None:
+        parsed = parse_multiple_ingredients(sentences=toParse)
+
+    for i, res in zip(misses, parsed):
+        if res != None:
+            PARSE_CACHE.set(normalize_key(sentences[i]), res)
+        results[i] = res
+    return results
+
+
+# Search foods from the configured source
+def search_foods(food, source=None):
+    source = source or USDA_SOURCE
+    if source == "local" and usdaIndex.is_available():
+        return usdaIndex.search_foods(food)
+    return search_usda_data(food)
 
 
 # Convert values from parser to gram estimates
@@ -90,18 +277,27 @@ def convert_grams(amount, category=""):
     # to Mass conversion (get grams)
     # We are approximating, skip ingredients with no compareable units
     unitName = f"{amount.unit}".lower()
-    if unitName not in UREG:
+    if unitName in UNIT_TABLE:
+        unit = UNIT_TABLE[unitName]
+    else:
+        unit = UNIT_CACHE.get(unitName)
+        if unit == None:
+            try:
+                unit = _pint_unit(unitName)
+            except Exception:
+                unit = None
+            UNIT_CACHE.set(unitName, unit or False)    # False remembers units pint can not read
+    if not unit:
         # TODO could look into RTCC in fetch_usda_data (leave approx for now)
         return None
     
     # Calculate approximate mass for USDA data
-    if UREG(unitName).check("[mass]"):
-        grams = (float(amount.quantity) * UREG(unitName)).to("gram").magnitude
-    elif UREG(unitName).check("[volume]"):
+    kind, factor = unit
+    if kind == "mass":
+        grams = float(amount.quantity) * factor
+    elif kind == "volume":
         density = DENSITIES.get(category)
-        density = (density[0] if density else 1) * UREG("gram / milliliter")
-        volume = float(amount.quantity) * UREG(unitName)
-        grams = (volume * density).to("gram").magnitude
+        grams = float(amount.quantity) * factor * (density[0] if density else 1)
     else:
         grams = 0
     
@@ -111,27 +307,13 @@ def convert_grams(amount, category=""):
 # Extract nutrients from USDA data
 # Store as per 1 gram (USDA data is stored as 100 grams)
 def extract_nutrients(food, grams):
-    kcal = 0
-    nutrients = [0 for i in range(len(NUTRIENT_KEYS) + 1)]
-    for item in food.get("foodNutrients", []):
-        key = item["nutrientNumber"]
-        value = round(item["value"] / 100, 2)
-        match key:
-            case "203":     # Protein
-                kcal += value * 4
-            case "204":     # Fat
-                kcal += value * 9
-            case "205":     # Carbs
-                kcal += value * 4
-        if key in NUTRIENT_KEYS:
-            nutrients[NUTRIENT_KEYS.index(key) + 1] = value     
-    nutrients[0] = round(kcal, 2)
-    return nutrients
+    return to_list(nutrient_vector(food))
 
 
 # Get nutrient approximation for 1 ingredient
 # Returns (max 5) options
-def get_nutrients(ingredient):
+# source overrides USDA_SOURCE ("remote" or "local")
+def get_nutrients(ingredient, source=None):
     
     if ingredient.name == None:
         return
@@ -147,7 +329,7 @@ def get_nutrients(ingredient):
             amount = None
 
     # Loop over options
-    for food in search_usda_data(rawName).get("foods", []):
+    for food in search_foods(rawName, source).get("foods", []):
 
         name = food.get("description", "").lower()
 
@@ -177,39 +359,110 @@ def get_nutrients(ingredient):
     return None
 
 
+# Run multiple threaded searches on the shared NUTRITION_POOL
+# Yields (input index, options) as each search finishes (options None when nothing matched)
+# Lines whose lookup failed (not parsed, no room in the pool's queue, USDA error, missed
+#   deadline) come back as failed, None unless the caller needs to tell them apart from no match
+def iter_indexed_nutrients(ingredients, failed=None):
+    futures = {}
+    try:
+        for i, ing in enumerate(ingredients):
+            if ing == None:
+                yield i, failed     # not parsed in time
+                continue
+            try:
+                futures[NUTRITION_POOL.submit(get_nutrients, ing)] = i
+            except QueueFull as e:
+                print(f"Nutrition lookup skipped - {e}")
+                yield i, failed
+
+        pending = set(futures.values())
+        try:
+            for future in concurrent.futures.as_completed(futures, timeout=usdaClient.DEADLINE):
+                pending.discard(futures[future])
+                try:
+                    res = future.result()
+                except usdaClient.USDAError as e:
+                    print(f"USDA search failed ({ingredients[futures[future]].sentence}) - {e}")
+                    yield futures[future], failed
+                    continue
+                yield futures[future], (next(iter(res.values())) if res != None else None)
+        except concurrent.futures.TimeoutError:
+            print(f"Nutrition lookup deadline hit, {len(pending)} ingredients unresolved")
+            for i in pending:
+                yield i, failed
+    finally:
+        # Consumer may stop early (client hung up), drop work not started yet
+        for future in futures:
+            future.cancel()
+
+
+# Returns {input index: options}
+def get_indexed_nutrients(ingredients):
+    return dict(iter_indexed_nutrients(ingredients))
+
+
 # Run multiple threaded searches, sum nutritional values
 # Returns (max 5) options per ingredient
 def get_multiple_nutrients(ingredients):
     nutrients = {}
-    with concurrent.futures.ThreadPoolExecutor(10) as executor:
-        futures = {executor.submit(get_nutrients, ing): ing for ing in ingredients}
-        for future in concurrent.futures.as_completed(futures):
-            res = future.result()
-            if res != None:
-                nutrients = nutrients | res
-        
-        return nutrients
+    for i, res in get_indexed_nutrients(ingredients).items():
+        if res != None:
+            nutrients[ingredients[i].sentence] = res
+    return nutrients
 
 
 # Get nutrition for 1 ingredient
 def get_ingredient_nutrition(ingredient):
-    parsed = parse_ingredient(ingredient)
+    parsed = parse_one(ingredient)
     if parsed == None:
         return None
     
-    nutrients = get_nutrients(parsed)
+    try:
+        nutrients = get_nutrients(parsed)
+    except usdaClient.USDAError as e:
+        # Degraded USDA, this ingredient just gets no match
+        print(f"USDA search failed ({ingredient}) - {e}")
+        nutrients = None
     if nutrients == None:
         return {"ingredient": ingredient, "nutrients": [0] * 15}
     return nutrients[parsed.sentence]
 
 
+# Get nutrition for a list of ingredient strings
+# Yields (input index, options) in completion order, blank lines come back first as None
+# failed marks lookups that failed, see iter_indexed_nutrients
+def iter_batch_nutrition(ingredients, failed=None):
+    indexes = []
+    for i, ing in enumerate(ingredients):
+        if ing and ing.strip():
+            indexes.append(i)
+        else:
+            yield i, None
+    if len(indexes) == 0:
+        return
+
+    parsed = parse_many([ingredients[i] for i in indexes])
+    for pos, res in iter_indexed_nutrients(parsed, failed=failed):
+        yield indexes[pos], res
+
+
+# Get nutrition for a list of ingredient strings in one go
+# Returns a list aligned with the input (None where nothing matched, failed where the lookup failed)
+def get_batch_nutrition(ingredients, failed=None):
+    nutrients = [None] * len(ingredients)
+    for i, res in iter_batch_nutrition(ingredients, failed=failed):
+        nutrients[i] = res
+    return nutrients
+
+
 # The one to call
 # Uses previous functions to compile nutritional data
 def get_recipe_nutrition(recipe):
 
     ingredients = recipe["ingredients"]
     unsorted_nutrients = get_multiple_nutrients(
-        parse_multiple_ingredients(sentences=ingredients)
+        parse_many(ingredients)
     )
 
     nutrients = [None for i in range(len(ingredients))]
@@ -223,10 +476,71 @@ def get_recipe_nutrition(recipe):
     return nutrients
 
 
-# Scrape recipe from link
+# Scraped recipes by canonical url, shared by workers like USDA_CACHE
+SCRAPE_CACHE = TieredCache(
+    path=os.getenv("SCRAPE_CACHE_PATH", "scrape_cache.sqlite3"),
+    table="scrape",
+    maxsize=env_number("SCRAPE_CACHE_SIZE", 256),
+    maxrows=env_number("SCRAPE_CACHE_ROWS", 5000),
+    ttl=env_number("SCRAPE_CACHE_TTL", 24 * 60 * 60)
+)
+
+
+# Canonical form of a recipe url so the same page matches however it was pasted
+#   lowercase scheme / host, no "www.", fragment, tracking params or trailing slash
+def canonical_url(link):
+    if not link:
+        return link
+    parts = urlsplit(link.strip())
+    host = parts.netloc.lower().removeprefix("www.")
+    query = urlencode([
+        (k, v) for k, v in parse_qsl(parts.query) if not k.lower().startswith("utm_")
+    ])
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower() or "https", host, path, query, ""))
+
+
+# Scrape recipe from link, served from SCRAPE_CACHE when seen recently
 def scrape_link(link):
+    key = canonical_url(link)
+    cached = SCRAPE_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    recipe = _scrape_link(link)
+    if recipe != None:
+        SCRAPE_CACHE.set(key, recipe)
+        # Page may declare its own canonical url, remember that spelling too
+        if recipe.get("link") and canonical_url(recipe["link"]) != key:
+            SCRAPE_CACHE.set(canonical_url(recipe["link"]), recipe)
+    return recipe
+
+
+# Page fetches give up after SCRAPE_TIMEOUT seconds in total (a slow site must not hold a
+#   scrape worker forever) and past SCRAPE_MAX_BYTES
+SCRAPE_TIMEOUT = env_number("SCRAPE_TIMEOUT", 30, float)
+SCRAPE_MAX_BYTES = env_number("SCRAPE_MAX_BYTES", 5 * 1024 * 1024)
+SCRAPE_HEADERS = {"User-Agent": "Mozilla/5.0 (compatible; recipe-scrapers)"}
+
+
+def _fetch_page(link):
+    deadline = time.monotonic() + SCRAPE_TIMEOUT
+    with requests.get(link, headers=SCRAPE_HEADERS, timeout=(usdaClient.CONNECT_TIMEOUT, SCRAPE_TIMEOUT), stream=True) as res:
+        res.raise_for_status()
+        body = bytearray()
+        for chunk in res.iter_content(64 * 1024):
+            body += chunk
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"page took over {SCRAPE_TIMEOUT}s")
+            if len(body) > SCRAPE_MAX_BYTES:
+                raise ValueError(f"page over {SCRAPE_MAX_BYTES} bytes")
+    return body.decode("utf-8", errors="replace")
+
+
+# Uncached scrape, only called through scrape_link
+def _scrape_link(link):
     try:
-        scraper = scrape_me(link)
+        scraper = scrape_html(_fetch_page(link), org_url=link)
         raw = scraper.to_json()
         recipe = {
             "link": raw.get("canonical_url"),
@@ -0,0 +1,70 @@
+## Background recipe link scraping
+## Submitting a link returns a job id right away, the page polls for the result
+##   - SCRAPE_WORKERS scrapes at once per process, SCRAPE_QUEUE more may wait
+##   - jobs still pending after SCRAPE_TIMEOUT seconds are reported failed, the page fetch
+##     itself gives up at the same deadline (recipeUtil._fetch_page) and frees its worker
+##   - job state lives in a SQLite file so any gunicorn worker can answer a poll,
+##     finished results are kept SCRAPE_RESULT_TTL seconds and reused for the same link
+
+import os
+import time
+import uuid
+
+from cache import LRUCache, SQLiteStore, env_number
+from workQueue import BoundedExecutor, QueueFull
+from recipeUtil import scrape_link, canonical_url
+
+JOB_TIMEOUT = env_number("SCRAPE_TIMEOUT", 30, float)
+RESULT_TTL = env_number("SCRAPE_RESULT_TTL", 60 * 60)
+
+SCRAPE_POOL = BoundedExecutor(
+    workers=env_number("SCRAPE_WORKERS", 4),
+    queue_size=env_number("SCRAPE_QUEUE", 32),
+    name="scrape"
+)
+
+# Each submitted link adds two rows (job + link), oldest expiring go first past SCRAPE_JOB_ROWS
+_path = os.getenv("SCRAPE_JOB_PATH", "scrape_jobs.sqlite3")
+JOBS = SQLiteStore(_path, table="scrape_jobs", maxrows=env_number("SCRAPE_JOB_ROWS", 10000)) if _path else LRUCache(maxsize=1000, ttl=RESULT_TTL)
+
+
+def _run(jobID, link):
+    recipe = scrape_link(link)
+    job = JOBS.get(f"job:{jobID}") or {"link": link, "created": time.time()}
+    if recipe == None:
+        job |= {"status": "failed", "error": "Unable to parse link"}
+    else:
+        job |= {"status": "done", "recipe": recipe}
+    JOBS.set(f"job:{jobID}", job, ttl=RESULT_TTL)
+
+
+# Queue a scrape, returns the job id
+# A pending or finished job for the same link is reused instead of scraping again
+# Raises QueueFull when too many scrapes are already waiting
+def submit(link):
+    existing = JOBS.get(f"link:{canonical_url(link)}")
+    if existing != None:
+        job = status(existing)
+        if job != None and job["status"] != "failed":
+            return existing
+
+    jobID = uuid.uuid4().hex
+    JOBS.set(f"job:{jobID}", {"status": "pending", "link": link, "created": time.time()}, ttl=RESULT_TTL)
+    try:
+        SCRAPE_POOL.submit(_run, jobID, link)
+    except QueueFull:
+        JOBS.set(f"job:{jobID}", {"status": "failed", "link": link, "error": "Too many imports running, try again shortly"}, ttl=60)
+        raise
+    JOBS.set(f"link:{canonical_url(link)}", jobID, ttl=RESULT_TTL)
+    return jobID
+
+
+# Job state: {"status": pending | done | failed, "link", "recipe" (done), "error" (failed)}
+# None if the id is unknown or expired
+def status(jobID):
+    job = JOBS.get(f"job:{jobID}")
+    if job == None:
+        return None
+    if job["status"] == "pending" and time.time() - job.get("created", 0) > JOB_TIMEOUT:
+        job |= {"status": "failed", "error": "Timed out fetching recipe"}
+    return job
@@ -59,6 +59,38 @@ function calcEstimate() {
 }
 
 
+// Fill list item with USDA matches (data is a list of options, or null)
+function fillIngredient(item, data) {
+
+    const span = item.querySelector("span");
+    if(!data || data.length === 0) {
+        span.innerHTML = "Unable to find suitable data"
+        return 1;
+    }
+    span.innerHTML = "USDA Nutritional Match: "
+    const grams = span.appendChild(document.createElement("input"));
+    grams.type = "number";
+    grams.step = "0.01"
+    grams.className = "USDA_grams"
+    grams.value = data[0].amount;
+    span.insertAdjacentText("beforeend", " grams of ");
+
+    const select = span.appendChild(document.createElement("select"));
+    select.className = "USDA_base"
+    const noOpt = select.appendChild(document.createElement("option"));
+    noOpt.value = "";
+    noOpt.innerHTML = "None";
+
+    for(const nutrient of data) {
+        const opt = select.appendChild(document.createElement("option"));
+        opt.value = `${nutrient.nutrition}`
+        opt.innerHTML = nutrient.name
+    }
+    select.options[1].selected = true
+    return 1;
+}
+
+
 // Estimate list item ingredient
 // Returns 1 for initial page load (load nutritional label)
 async function estimateIngredient(item, text) {
@@ -67,39 +99,71 @@ async function estimateIngredient(item, text) {
     const params = new URLSearchParams({"ingredient": text})
     return fetch(`/api/nutrition?${params.toString()}`)
     .then(raw => raw.json())
-    .then(res => {
+    .then(res => fillIngredient(item, res && res.success ? res.data : null))
+    .catch(_ => fillIngredient(item, null));
+}
 
-        const span = item.querySelector("span");
-        if(!res || !res.success) {
-            span.innerHTML = "Unable to find suitable data"
-            return 1;
-        }
-        span.innerHTML = "USDA Nutritional Match: "
-        const grams = span.appendChild(document.createElement("input"));
-        grams.type = "number";
-        grams.step = "0.01"
-        grams.className = "USDA_grams"
-        grams.value = res.data[0].amount;
-        span.insertAdjacentText("beforeend", " grams of ");
-
-        const select = span.appendChild(document.createElement("select"));
-        select.className = "USDA_base"
-        const noOpt = select.appendChild(document.createElement("option"));
-        noOpt.value = "";
-        noOpt.innerHTML = "None";
-
-        for(const nutrient of res.data) {
-            const opt = select.appendChild(document.createElement("option"));
-            opt.value = `${nutrient.nutrition}`
-            opt.innerHTML = nutrient.name
-        }
-        select.options[1].selected = true
+
+// Estimate many list items with one request
+// items is a list of [li element, ingredient text]
+async function estimateIngredients(items) {
+    if(items.length === 0)
+        return 1;
+
+    return fetch("/api/nutrition/batch", {
+        method: "POST",
+        headers: {"Content-Type": "application/json"},
+        body: JSON.stringify({ingredients: items.map(([_, text]) => text)})
+    })
+    .then(raw => raw.json())
+    .then(res => {
+        items.forEach(([item, _], i) => 
+            fillIngredient(item, res && res.success ? res.data[i] : null));
         return 1;
     })
     .catch(_ => {
-        const span = item.querySelector("span");
-        span.innerHTML = "Unable to find suitable data"
+        items.forEach(([item, _]) => fillIngredient(item, null));
+        return 1;
+    });
+}
+
+
+// Stream matches for many list items, label updates as each one resolves
+// Falls back to the batch request if streaming is unavailable or fails
+async function streamIngredients(items) {
+    if(items.length === 0)
         return 1;
+
+    const params = new URLSearchParams();
+    for(const [_, text] of items)
+        params.append("ingredient", text);
+    const url = `/api/nutrition/stream?${params.toString()}`;
+
+    // gunicorn rejects request lines over ~4k
+    if(!window.EventSource || url.length > 4000)
+        return estimateIngredients(items);
+
+    return new Promise(resolve => {
+        const filled = new Set();
+        const source = new EventSource(url);
+
+        source.addEventListener("ingredient", (event) => {
+            const res = JSON.parse(event.data);
+            filled.add(res.index);
+            fillIngredient(items[res.index][0], res.data);
+            updateNutrients(calcEstimate());
+        });
+
+        source.addEventListener("done", () => {
+            source.close();
+            resolve(1);
+        });
+
+        // EventSource would reconnect and restart, finish the rest with one batch instead
+        source.onerror = () => {
+            source.close();
+            resolve(estimateIngredients(items.filter((_, i) => !filled.has(i))));
+        };
     });
 }
 
@@ -268,7 +332,7 @@ form.addEventListener("submit", (event) => {
         let grams = item.querySelector("input[type=number]");
         let name = item.querySelector("select")
         if(grams && name) {
-            grams = parseFloat(grams);
+            grams = parseFloat(grams.value);
             name = name.selectedOptions[0];
             nutrients.push({
                 name: name.innerHTML.trim(),
@@ -325,22 +389,39 @@ document.querySelector("#clear-all").addEventListener("click", () => {
 
 // Load nutritional info on document load
 document.addEventListener("DOMContentLoaded", () => {
-    let results = []
+    let pending = []
     const items = ingZone.querySelectorAll("li");
     for(let item of items) {
         const text = item.querySelector("input[type=text]");
         const grams = item.querySelector("input[type=number]");
         if(grams == null || !grams.readOnly)
-            results.push(estimateIngredient(item, text.value));
+            pending.push([item, text.value]);
     }
 
-    // Once all promises resolved, calculate nutritional label
-    Promise.all(results).then(() => {
+    // Stream results in, then calculate final nutritional label
+    streamIngredients(pending).then(() => {
         updateNutrients(calcEstimate())
     });
 });
 
 
+// Autofill link is being scraped in the background, reload once it finishes
+const scrapeJob = document.querySelector("#scrape-job");
+if(scrapeJob) {
+    const poll = setInterval(() => {
+        fetch(`/api/scrape/${scrapeJob.dataset.job}`)
+        .then(raw => raw.json())
+        .then(res => {
+            if(!res.success || res.job.status !== "pending") {
+                clearInterval(poll);
+                window.location.reload();
+            }
+        })
+        .catch(_ => {});
+    }, 1000);
+}
+
+
 // Delete button
 const deleteButton = document.querySelector("#delete-button");
 if(deleteButton) {
@@ -0,0 +1,192 @@
+## Shared HTTP client for the USDA FoodData Central api
+##   - one keep-alive Session with a sized connection pool
+##   - connect/read timeouts per attempt plus an overall deadline per call
+##   - jittered exponential backoff on 429 / 5xx / connection errors
+##   - token bucket sized to the api key quota (default 1000 requests / hour)
+##   - circuit breaker, fails fast while USDA is degraded
+## Every limit is per process, divide the quota by the gunicorn worker count
+
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cache import env_number
+
+POOL_SIZE = env_number("USDA_POOL_SIZE", 10)
+CONNECT_TIMEOUT = env_number("USDA_CONNECT_TIMEOUT", 3.05, float)
+READ_TIMEOUT = env_number("USDA_READ_TIMEOUT", 10, float)
+DEADLINE = env_number("USDA_DEADLINE", 20, float)
+RETRIES = env_number("USDA_RETRIES", 3)
+RATE_PER_HOUR = env_number("USDA_RATE_PER_HOUR", 1000, float)
+BURST = env_number("USDA_BURST", 20)
+BREAKER_THRESHOLD = env_number("USDA_BREAKER_THRESHOLD", 5)
+BREAKER_COOLDOWN = env_number("USDA_BREAKER_COOLDOWN", 30, float)
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+# Raised when a call could not be completed (caller decides how to degrade)
+class USDAError(Exception):
+    pass
+
+class USDACircuitOpen(USDAError):
+    pass
+
+class USDARateLimited(USDAError):
+    pass
+
+
+# Classic token bucket, refills continuously at rate tokens / second
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Take one token, waiting up to timeout seconds, False if none came free
+    def acquire(self, timeout=0):
+        end = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if time.monotonic() + wait > end:
+                return False
+            time.sleep(wait)
+
+
+# closed -> (threshold consecutive failures) -> open -> (cooldown) -> half open
+# Half open lets one trial call through, success closes, failure re-opens
+class CircuitBreaker:
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return "closed"
+        if time.monotonic() - self.opened < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    # Give back a half open trial that never reached USDA
+    def release(self):
+        with self._lock:
+            self.trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial = False
+            if self.opened is not None or self.failures >= self.threshold:
+                self.opened = time.monotonic()
+
+
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=POOL_SIZE))
+
+LIMITER = TokenBucket(RATE_PER_HOUR / 3600, BURST)
+BREAKER = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+
+_counters = {"calls": 0, "retries": 0, "failures": 0, "rejected": 0}
+_counter_lock = threading.Lock()
+
+
+def _count(name):
+    with _counter_lock:
+        _counters[name] += 1
+
+
+# Full jitter backoff, honour Retry-After when USDA sends one
+def _backoff(attempt, res=None):
+    if res is not None and res.headers.get("Retry-After", "").isdigit():
+        return float(res.headers["Retry-After"])
+    return random.uniform(0, min(4, 0.25 * 2 ** attempt))
+
+
+# GET json from USDA, raises USDAError once retries / deadline / breaker run out
+def get(url, params, deadline=DEADLINE):
+    _count("calls")
+    end = time.monotonic() + deadline
+
+    if not BREAKER.allow():
+        _count("rejected")
+        raise USDACircuitOpen("USDA circuit open")
+
+    error = None
+    for attempt in range(RETRIES + 1):
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            break
+        if not LIMITER.acquire(timeout=remaining):
+            _count("rejected")
+            BREAKER.release()   # our limiter said no, not USDA
+            raise USDARateLimited("USDA request quota exhausted")
+
+        res = None
+        try:
+            res = SESSION.get(
+                url, params=params,
+                timeout=(CONNECT_TIMEOUT, min(READ_TIMEOUT, max(end - time.monotonic(), 0.1)))
+            )
+            if res.status_code not in RETRY_STATUS:
+                BREAKER.success()
+                return res.json()
+            error = USDAError(f"USDA returned {res.status_code}")
+        except (requests.ConnectionError, requests.Timeout, ValueError) as e:
+            error = USDAError(f"USDA request failed - {e}")
+
+        if attempt < RETRIES:
+            delay = _backoff(attempt, res)
+            if time.monotonic() + delay >= end:
+                break
+            _count("retries")
+            time.sleep(delay)
+
+    _count("failures")
+    BREAKER.failure()
+    raise error or USDAError("USDA deadline exceeded")
+
+
+def stats():
+    return _counters | {
+        "breaker": BREAKER.state,
+        "tokens": round(LIMITER.tokens, 2),
+        "pool_size": POOL_SIZE
+    }
@@ -0,0 +1,201 @@
+## Offline USDA FoodData Central index
+## Loads a downloaded FDC csv dump (Foundation / SR Legacy) into a local SQLite file
+##   https://fdc.nal.usda.gov/download-datasets
+##
+## Import:  python usdaIndex.py import <dir with food.csv, food_nutrient.csv, ...>
+## Search results mimic the /foods/search api response so get_nutrients can use either
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from nutrients import NUTRIENT_KEYS
+
+INDEX_PATH = os.getenv("USDA_INDEX_PATH", "usda_index.sqlite3")
+DATA_TYPES = ("foundation_food", "sr_legacy_food")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS foods (
+    fdc_id INTEGER PRIMARY KEY,
+    data_type TEXT,
+    description TEXT NOT NULL,
+    category TEXT,
+    nutrients TEXT NOT NULL     -- json list, NUTRIENT_KEYS order, per 100 g
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS foods_fts USING fts5(
+    description, content='foods', content_rowid='fdc_id', tokenize='porter unicode61'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS foods_tri USING fts5(
+    description, content='foods', content_rowid='fdc_id', tokenize='trigram'
+);
+"""
+
+
+## Import ##
+
+
+# csv nutrient numbers show up as "203" or "203.0" depending on the release
+def _nutrient_number(value):
+    value = f"{value}".strip()
+    return value[:-2] if value.endswith(".0") else value
+
+
+def _read_csv(csv_dir, name):
+    path = os.path.join(csv_dir, name)
+    with open(path, newline='', encoding="utf-8") as f:
+        yield from csv.DictReader(f)
+
+
+# Build (or rebuild) the index from an FDC csv directory
+def import_fdc(csv_dir, path=INDEX_PATH, data_types=DATA_TYPES):
+    start = time.time()
+
+    categories = {
+        row["id"]: row["description"] for row in _read_csv(csv_dir, "food_category.csv")
+    }
+
+    # nutrient id (csv) -> column in NUTRIENT_KEYS
+    columns = {}
+    for row in _read_csv(csv_dir, "nutrient.csv"):
+        number = _nutrient_number(row.get("nutrient_nbr", ""))
+        if number in NUTRIENT_KEYS:
+            columns[row["id"]] = NUTRIENT_KEYS.index(number)
+
+    foods = {}
+    for row in _read_csv(csv_dir, "food.csv"):
+        if data_types and row.get("data_type") not in data_types:
+            continue
+        foods[row["fdc_id"]] = {
+            "data_type": row.get("data_type"),
+            "description": row.get("description", ""),
+            "category": categories.get(row.get("food_category_id")),
+            "nutrients": [0.0] * len(NUTRIENT_KEYS)
+        }
+
+    for row in _read_csv(csv_dir, "food_nutrient.csv"):
+        food = foods.get(row["fdc_id"])
+        column = columns.get(row["nutrient_id"])
+        if food is None or column is None or row.get("amount") in (None, ""):
+            continue
+        food["nutrients"][column] = float(row["amount"])
+
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("DROP TABLE IF EXISTS foods_fts")
+        conn.execute("DROP TABLE IF EXISTS foods_tri")
+        conn.execute("DROP TABLE IF EXISTS foods")
+        conn.executescript(SCHEMA)
+        conn.executemany(
+            "INSERT INTO foods (fdc_id, data_type, description, category, nutrients) VALUES (?, ?, ?, ?, ?)",
+            (
+                (int(fdc_id), food["data_type"], food["description"], food["category"], json.dumps(food["nutrients"]))
+                for fdc_id, food in foods.items()
+            )
+        )
+        conn.execute("INSERT INTO foods_fts(foods_fts) VALUES ('rebuild')")
+        conn.execute("INSERT INTO foods_tri(foods_tri) VALUES ('rebuild')")
+    conn.execute("VACUUM")
+    conn.close()
+
+    print(f"Indexed {len(foods)} foods into {path} in {time.time() - start:.1f}s")
+    return len(foods)
+
+
+## Search ##
+
+
+_local = threading.local()
+
+
+def _connect(path):
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    if path not in conns:
+        conns[path] = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    return conns[path]
+
+
+def is_available(path=INDEX_PATH):
+    return os.path.exists(path)
+
+
+# Quote each word so fts5 does not read user text as query syntax
+def _match_terms(text, joiner):
+    words = [word.replace('"', '') for word in f"{text}".split()]
+    return f" {joiner} ".join(f'"{word}"' for word in words if word)
+
+
+# Search the local index, returns the same shape as the USDA search api
+#   word match (all terms, then any term) ranked by bm25, trigram substring match as a fallback
+def search_foods(food, pageSize=10, path=INDEX_PATH):
+    conn = _connect(path)
+    queries = [
+        ("foods_fts", _match_terms(food, "AND")),
+        ("foods_fts", _match_terms(food, "OR")),
+        ("foods_tri", _match_terms(food, "OR"))
+    ]
+
+    rows = []
+    for table, match in queries:
+        if not match:
+            continue
+        try:
+            rows = conn.execute(
+                f"""
+                SELECT f.fdc_id, f.description, f.category, f.nutrients
+                FROM {table} JOIN foods f ON f.fdc_id = {table}.rowid
+                WHERE {table} MATCH ?
+                ORDER BY bm25({table}), length(f.description)
+                LIMIT ?
+                """,
+                (match, pageSize)
+            ).fetchall()
+        except sqlite3.OperationalError:
+            rows = []   # trigram terms shorter than 3 chars etc
+        if len(rows) > 0:
+            break
+
+    return {"foods": [
+        {
+            "fdcId": fdc_id,
+            "description": description,
+            "foodCategory": category,
+            "foodNutrients": [
+                {"nutrientNumber": key, "value": value}
+                for key, value in zip(NUTRIENT_KEYS, json.loads(nutrients))
+            ]
+        }
+        for fdc_id, description, category, nutrients in rows
+    ]}
+
+
+## CLI ##
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local USDA FoodData Central index")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    imp = sub.add_parser("import", help="load an FDC csv dump")
+    imp.add_argument("csv_dir")
+    imp.add_argument("--db", default=INDEX_PATH)
+    imp.add_argument("--all-types", action="store_true", help="keep every data_type in food.csv")
+
+    find = sub.add_parser("search", help="query the index")
+    find.add_argument("query")
+    find.add_argument("--db", default=INDEX_PATH)
+
+    args = parser.parse_args()
+    if args.command == "import":
+        import_fdc(args.csv_dir, path=args.db, data_types=None if args.all_types else DATA_TYPES)
+    elif args.command == "search":
+        start = time.perf_counter()
+        res = search_foods(args.query, path=args.db)
+        for food in res["foods"]:
+            print(f"{food['fdcId']:>8}  {food['description']}  ({food['foodCategory']})")
+        print(f"{(time.perf_counter() - start) * 1000:.2f} ms")
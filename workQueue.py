@@ -0,0 +1,76 @@
+## Process wide, bounded thread pools
+## Work beyond (workers + queue size) outstanding tasks is rejected instead of piling up
+
+import concurrent.futures
+import threading
+
+
+# Raised by submit when the pool and its queue are full
+class QueueFull(Exception):
+    pass
+
+
+class BoundedExecutor:
+
+    def __init__(self, workers, queue_size, name="pool"):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.active = 0
+        self.outstanding = 0
+        self.completed = 0
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix=name)
+
+    # Wrap fn to keep the active gauge honest
+    def _run(self, fn, args, kwargs):
+        with self._lock:
+            self.active += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    # Called when a task finishes or is cancelled
+    def _release(self, future):
+        with self._lock:
+            self.outstanding -= 1
+            if not future.cancelled():
+                self.completed += 1
+        self._slots.release()
+
+    # Submit fn, waiting up to timeout seconds for room (0 = fail right away)
+    def submit(self, fn, *args, timeout=0, **kwargs):
+        if timeout:
+            acquired = self._slots.acquire(timeout=timeout)
+        else:
+            acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                self.rejected += 1
+            raise QueueFull(f"{self.name} queue full ({self.workers} workers, {self.queue_size} queued)")
+
+        with self._lock:
+            self.outstanding += 1
+        try:
+            future = self._executor.submit(self._run, fn, args, kwargs)
+        except Exception:
+            with self._lock:
+                self.outstanding -= 1
+            self._slots.release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "active": self.active,
+            "queued": max(self.outstanding - self.active, 0),
+            "completed": self.completed,
+            "rejected": self.rejected
+        }